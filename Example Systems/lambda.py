@@ -33,14 +33,12 @@ params["zeeman"] = True
 
 Blist = np.linspace(-5e-6, 5e-6, 500)
 fl = np.zeros_like(Blist)
+template = AtomSystem(levels, lasers, params, decays=decays).compile()
 for i, B in enumerate(Blist):
-    params["B"] = B
-    atom = AtomSystem(levels, lasers, params, decays=decays)
-    H = atom.H
-    c_ops = atom.c_ops
-    result, e_ops = atom.solve()
-    fl[i] = qu.expect(atom.e_ops["2 $m_J=$1/2"], result.states[-1]) + qu.expect(
-        atom.e_ops["2 $m_J=$-1/2"], result.states[-1]
+    atom = template.instantiate({"B": B})
+    rho_ss = atom.steady_state()
+    fl[i] = qu.expect(atom.e_ops["2 $m_J=$1/2"], rho_ss) + qu.expect(
+        atom.e_ops["2 $m_J=$-1/2"], rho_ss
     )
 
 plt.figure()
@@ -31,14 +31,8 @@ params["t_max"] = 20
 params["n_step"] = 200
 
 atom = AtomSystem(levels, lasers, params, decays=[], cavities=[cavity])
-result, e_ops = atom.solve()
-eff = (
-    2
-    * cavity.kappa
-    * sum(qu.expect(result.states, e_ops["n"]))
-    * 100
-    * (params["t_max"] / params["n_step"])
-)
+result, e_ops = atom.solve(flux=True)
+eff = result.flux[cavity.name + "kappa"][-1] * 100
 print(eff)
 tlist = atom.tlist
 laser_fn = gaussian(tlist, gauss_args)
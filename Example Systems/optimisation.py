@@ -6,8 +6,7 @@ from system_builder import AtomSystem
 from systems import default_params
 from scipy.optimize import minimize
 from H_funcs import gaussian
-
-from bayes_opt import BayesianOptimization, SequentialDomainReductionTransformer
+import optimize
 
 t_max = 10 / (2 * np.pi)
 # Params
@@ -39,33 +38,21 @@ def phogun(Omega, Delta, Delta_c):
     cavity = Cavity(g=1, Delta=Delta_c, kappa=kappa, L1="3", L2="2", N=3, n=0)
 
     atom = AtomSystem(levels, lasers, params, decays=decays, cavities=[cavity])
-    result, e_ops = atom.solve()
+    result, e_ops = atom.solve(flux=True)
 
     return result, e_ops, atom
 
 
 def phogun_eff(Omega, Delta, Delta_c):
     result, e_ops, atom = phogun(Omega, Delta, Delta_c)
-    eff = (
-        2
-        * kappa
-        * sum(qu.expect(result.states, e_ops["n"]))
-        * 100
-        * (params["t_max"] / params["n_step"])
-    )
+    eff = result.flux[atom.cavity.name + "kappa"][-1] * 100
     return eff
 
 
 def phogun_eff_array(x):
     Omega, Delta, Delta_c = x
     result, e_ops, atom = phogun(Omega, Delta, Delta_c)
-    eff = (
-        2
-        * kappa
-        * sum(qu.expect(result.states, e_ops["n"]))
-        * 100
-        * (params["t_max"] / params["n_step"])
-    )
+    eff = result.flux[atom.cavity.name + "kappa"][-1] * 100
     return -eff
 
 
@@ -76,24 +63,31 @@ def phogun_eff_delt(Delta):
 # Bounded region of parameter space
 pbounds = {"Omega": (0, 10), "Delta": (-50, 0), "Delta_c": (-50, 0)}
 
-bounds_transformer = SequentialDomainReductionTransformer(minimum_window=0.5)
-
-optimizer = BayesianOptimization(
-    f=phogun_eff,
-    pbounds=pbounds,
-    random_state=1,
-    # bounds_transformer=bounds_transformer
-)
-optimizer.maximize(
+# batched Bayesian optimisation on one compiled system, with the parameters of
+# each candidate set by key
+result, e_ops, atom = phogun(1, -25, -25)
+template = atom.compile()
+laser = atom.lasers[0].name
+keys = {
+    "Omega": laser + "Omega",
+    "Delta": laser + "Delta",
+    "Delta_c": atom.cavity.name + "Delta_c",
+}
+
+opt = optimize.optimize(
+    template,
+    atom.cavity.name + "kappa",
+    {keys[name]: bound for name, bound in pbounds.items()},
     init_points=2,
     n_iter=20,
+    seed=1,
 )
 
-print(optimizer.max)
+print(opt.fun * 100, opt.params)
 
-Omega_opt = optimizer.max["params"]["Omega"]
-Delta_opt = optimizer.max["params"]["Delta"]
-Delta_c_opt = optimizer.max["params"]["Delta_c"]
+Omega_opt = opt.params[keys["Omega"]]
+Delta_opt = opt.params[keys["Delta"]]
+Delta_c_opt = opt.params[keys["Delta_c"]]
 
 result, e_ops, atom = phogun(Omega_opt, Delta_opt, Delta_c_opt)
 tlist = atom.tlist
@@ -105,16 +99,9 @@ for label, op in e_ops.items():
 plt.plot(tlist, laser_fn, label="laser")
 plt.legend()
 
-Omegas = []
-Deltas = []
-Delta_cs = []
-for i, res in enumerate(optimizer.res):
-    Omega = res["params"]["Omega"]
-    Delta = res["params"]["Delta"]
-    Delta_c = res["params"]["Delta_c"]
-    Omegas.append(Omega)
-    Deltas.append(Delta)
-    Delta_cs.append(Delta_c)
+Omegas = opt.xs[:, 0]
+Deltas = opt.xs[:, 1]
+Delta_cs = opt.xs[:, 2]
 
 fig, axs = plt.subplots(nrows=3)
 axs[0].plot(Omegas)
@@ -143,6 +130,20 @@ plt.show()
 # plt.plot(Deltas)
 # plt.show()
 
-p = minimize(phogun_eff_array, [1, 25, 50])
+
+# gradient-based optimisation on the compiled system, with the gradient of the
+# efficiency from forward sensitivity solves
+def phogun_eff_grad(x):
+    eff, grad = optimize.gradient(
+        template,
+        atom.cavity.name + "kappa",
+        list(keys.values()),
+        dict(zip(keys.values(), x)),
+        method="sensitivity",
+    )
+    return -eff * 100, -grad * 100
+
+
+p = minimize(phogun_eff_grad, [1, 25, 50], jac=True)
 
 print(p["x"])
@@ -3,12 +3,38 @@ from functools import partial
 
 funcs = {}
 default_args = {}
+# pulse shapes as qutip string coefficients, formatted with the pulse args
+strings = {}
+# pieces of each pulse shape, see segments
+pieces = {}
 
 
 def func_generator(func, name):
     return partial(func, name=name)
 
 
+def compile_coeff(func, args, tlist=None, kind="string"):
+    # func from func_generator as a coefficient that mesolve evaluates without
+    # calling back into Python: a string with the values of the pulse args
+    # substituted (compiled by qutip with Cython), or for kind="array" the
+    # pulse sampled on tlist, which must be the tlist of the solve
+    name = func.keywords["name"]
+    if kind == "string":
+        shape = func.func.__name__
+        values = {key: float(args[name + key]) for key in default_args[shape]}
+        return strings[shape].format(**values)
+    if kind == "array":
+        return np.asarray(func(np.asarray(tlist), args), dtype=float)
+    raise ValueError("Unknown coefficient kind: {}".format(kind))
+
+
+def segments(func, args):
+    # [(t_start, t_end, value)] pieces of the pulse of func from
+    # func_generator, where value is the constant pulse value on the piece or
+    # None where the pulse varies; the pulse is 0 outside all pieces
+    return pieces[func.func.__name__](args, name=func.keywords["name"])
+
+
 def gaussian(t, args, name=""):
     sigma = args[name + "sigma"]
     mu = args[name + "mu"]
@@ -19,6 +45,12 @@ def gaussian(t, args, name=""):
 
 
 funcs["gaussian"] = gaussian
+strings["gaussian"] = (
+    "(t >= {t_on}) * (t < {t_off}) * exp(-((t - {mu}) / {sigma})**2)"
+)
+pieces["gaussian"] = lambda args, name="": [
+    (args[name + "t_on"], args[name + "t_off"], None)
+]
 gauss_args = {"sigma": 0.5, "mu": 2, "t_on": 1, "t_off": 3}
 default_args["gaussian"] = gauss_args
 
@@ -30,6 +62,10 @@ def switch(t, args, name=""):
 
 
 funcs["switch"] = switch
+strings["switch"] = "(t >= {t_on}) * (t < {t_off}) * 1.0"
+pieces["switch"] = lambda args, name="": [
+    (args[name + "t_on"], args[name + "t_off"], 1)
+]
 switch_args = {"t_on": 1, "t_off": 3}
 default_args["switch"] = switch_args
 
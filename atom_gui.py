@@ -2,6 +2,7 @@ import sys
 import json
 import numpy as np
 import copy
+from collections import OrderedDict
 from fractions import Fraction
 import time
 from datetime import datetime
@@ -24,6 +25,7 @@ import qutipfuncs as quf
 
 # from qobjects import Cavity, Level, Laser, Decay
 from system_builder import build_system_from_dict
+from result_cache import ResultCache, digest
 from systems import defaults_dict
 from H_funcs import funcs, default_args
 
@@ -31,6 +33,9 @@ L_dict = {"S": 0, "P": 1, "D": 2}
 L_dict_inv = {0: "S", 1: "P", 2: "D"}
 
 save_path = "results/"
+solve_options = {"store_states": False, "method": "eig"}
+# number of recent solves kept in memory, to redraw them without solving
+SOLVE_CACHE_SIZE = 32
 
 
 class AtomGui(QMainWindow):
@@ -893,6 +898,9 @@ class SolverWidget(QGroupBox):
         self.params = parent.paramsWidget.params
         self.layout = QHBoxLayout()
         self.exp_dict = {}
+        self.cache = ResultCache()
+        self.recent = OrderedDict()
+        self.pulses = []
 
         self.autoSolveBox = QCheckBox("Auto solve")
         self.autoSolveBox.setChecked(True)
@@ -931,8 +939,23 @@ class SolverWidget(QGroupBox):
     def solve_system(self):
         try:
             self.system_dict = self.parent.system_dict
-            self.system = build_system_from_dict(self.system_dict)
-            self.result, self.e_ops = self.system.solve()
+            # a configuration solved recently is redrawn without even
+            # building the system
+            key = digest(self.system_dict, solve_options)
+            if key in self.recent:
+                self.recent.move_to_end(key)
+            else:
+                self.system = build_system_from_dict(self.system_dict)
+                result, e_ops = self.system.solve(**solve_options, cache=self.cache)
+                pulses = [
+                    (laser.name, laser.func, dict(laser.args))
+                    for laser in self.system.lasers
+                    if laser.func
+                ]
+                self.recent[key] = (result, e_ops, pulses)
+                if len(self.recent) > SOLVE_CACHE_SIZE:
+                    self.recent.popitem(last=False)
+            self.result, self.e_ops, self.pulses = self.recent[key]
             self.main_widget.plotter.set_e_ops(self.e_ops)
         except Exception as e:
             print("Failed to solve system")
@@ -947,7 +970,7 @@ class SolverWidget(QGroupBox):
         params = self.main_widget.system_dict["params"]
         for key, op in self.e_ops.items():
             if self.main_widget.plotter.ops_dict[key].isChecked():
-                exp = qu.expect(op, self.result.states)
+                exp = self.result.expect[key]
                 self.exp_dict[key] = exp
                 tlist = np.linspace(
                     params["t_start"], params["t_max"], params["n_step"]
@@ -963,18 +986,14 @@ class SolverWidget(QGroupBox):
         #         laser_y = func(tlist, args, laser_name)
         #         laser_y /= max(laser_y)
         #         self.parent.plotter.plot(tlist, exp, label=laser_name + ' ' + func)
-        if self.system:
-            for laser in self.system.lasers:
-                if func_name := laser.func:
-                    laser_name = laser.name
-                    func = funcs[func_name]
-                    args = laser.args
-                    laser_y = func(tlist, args, laser_name)
-                    if m := laser_y.max() != 0:
-                        laser_y = laser_y / m
-                    self.parent.plotter.plot(
-                        tlist, laser_y, label=laser_name + " " + func_name
-                    )
+        for laser_name, func_name, args in self.pulses:
+            func = funcs[func_name]
+            laser_y = func(tlist, args, laser_name)
+            if m := laser_y.max() != 0:
+                laser_y = laser_y / m
+            self.parent.plotter.plot(
+                tlist, laser_y, label=laser_name + " " + func_name
+            )
 
     def init_section(self):
         pass
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sparse assembly of system operators.
+
+Operators are written straight into scipy.sparse matrices by index arithmetic
+and only wrapped in a Qobj once they are complete, rather than being summed
+from many basis outer products.
+"""
+from collections.abc import Mapping
+import numpy as np
+import qutip as qu
+import scipy.sparse as sp
+
+
+def block(dim, values, row, col):
+    # dim x dim matrix with the dense array values placed at (row, col)
+    i, j = np.nonzero(values)
+    return sp.coo_matrix((values[i, j], (i + row, j + col)), shape=(dim, dim)).tocsr()
+
+
+def diagonal(values):
+    # diagonal matrix, stored in DIA format until it is wrapped
+    return sp.diags(np.asarray(values), format="dia")
+
+
+def projector(dim, idx):
+    # |idx><idx| on a dim dimensional space
+    values = np.zeros(dim)
+    values[idx] = 1
+    return diagonal(values)
+
+
+def expand(matrix, n):
+    # extend an operator to the tensor product with an n dimensional identity
+    if n == 1:
+        return sp.csr_matrix(matrix)
+    return sp.kron(matrix, sp.identity(n, format="csr"), format="csr")
+
+
+def to_qobj(matrix, dims):
+    return qu.Qobj(matrix, dims=[dims, dims])
+
+
+class LazyOperators(Mapping):
+    """
+    Mapping of operators that are only built, by build(key), on first access.
+
+    Iterating over the mapping yields every available key, but only the keys
+    that have been looked up (or declared) hold a built operator.
+    """
+
+    def __init__(self, keys, build):
+        self._keys = list(keys)
+        self._available = set(self._keys)
+        self._build = build
+        self._ops = {}
+
+    def __getitem__(self, key):
+        if key not in self._ops:
+            if key not in self._available:
+                raise KeyError(key)
+            self._ops[key] = self._build(key)
+        return self._ops[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._available
+
+    @property
+    def built(self):
+        return list(self._ops.keys())
+
+    def declare(self, keys):
+        # build the operators for keys now, e.g. from a list of couplings
+        for key in keys:
+            self[key]
+
+
+class ParametricOperator:
+    """
+    Operator of the form sum_k c_k * A_k with fixed operators A_k.
+
+    Each coefficient is a constant factor times the value of a named
+    parameter (or its complex conjugate), or just the factor when the key is
+    None. All A_k are stored on their union sparsity pattern, so evaluating
+    the operator for new parameter values is a single sparse mat-vec.
+    """
+
+    def __init__(self, dims):
+        self.dims = dims
+        self.terms = []
+        self.ops = []
+        self._data = None
+
+    def add(self, op, key=None, factor=1, conj=False):
+        self.terms.append((key, factor, conj))
+        self.ops.append(op)
+        self._data = None
+
+    def keys(self):
+        return {key for key, _, _ in self.terms if key is not None}
+
+    def coefficients(self, values):
+        coeffs = np.zeros(len(self.terms), dtype=complex)
+        for k, (key, factor, conj) in enumerate(self.terms):
+            value = 1 if key is None else values[key]
+            coeffs[k] = factor * (np.conj(value) if conj else value)
+        return coeffs
+
+    def derivative(self, key):
+        # d/d(value) of the operator, treating the parameter as real
+        return self.evaluate(
+            [factor if k == key else 0 for k, factor, _ in self.terms]
+        )
+
+    def _compile(self):
+        n_rows = int(np.prod(np.ravel(self.dims[0])))
+        n_cols = int(np.prod(np.ravel(self.dims[1])))
+        entries = [op.data.tocoo() for op in self.ops]
+        positions = np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [e.row.astype(np.int64) * n_cols + e.col for e in entries]
+        )
+        pattern = np.unique(positions)
+        self._shape = (n_rows, n_cols)
+        self._indices = (pattern % n_cols).astype(np.int32)
+        counts = np.bincount(pattern // n_cols, minlength=n_rows)
+        self._indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+        # column k holds the entries of term k on the union pattern
+        values = np.concatenate([np.zeros(0)] + [e.data for e in entries])
+        terms = np.repeat(np.arange(len(entries)), [e.nnz for e in entries])
+        self._data = sp.csr_matrix(
+            (values, (np.searchsorted(pattern, positions), terms)),
+            shape=(len(pattern), len(entries)),
+            dtype=complex,
+        )
+
+    def evaluate(self, coeffs):
+        if self._data is None:
+            self._compile()
+        data = self._data @ np.asarray(coeffs, dtype=complex)
+        matrix = sp.csr_matrix(
+            (data, self._indices, self._indptr), shape=self._shape
+        )
+        return qu.Qobj(matrix, dims=self.dims)
+
+    def __call__(self, values):
+        return self.evaluate(self.coefficients(values))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gradients of integrated objectives over a compiled SystemTemplate.
+
+An objective is integrated over the time evolution: the number of quantum
+jumps through the collapse channel of a parameter key (the flux of
+solve(flux=True), e.g. the photons leaving the cavity through "32kappa"), or
+the time integral of <op> for an e_ops name or operator. Gradients are taken
+by central differences, with all displaced solves run on a process pool, or
+by forward sensitivity solves (see SolverMixin.sensitivity) for the
+parameters that enter the operators.
+
+optimize maximises (or minimises) an objective over bounded parameters with a
+Gaussian process surrogate, proposing whole batches of candidates that are
+solved concurrently by a pool of workers holding one compiled template.
+"""
+import os
+import numpy as np
+import qutip as qu
+import scipy.linalg as la
+from scipy.integrate import trapezoid
+from scipy.optimize import OptimizeResult
+from sweeps import parallel_map, worker_pool
+
+# template, fixed values and objective of the current worker process
+_worker = {}
+
+# candidate points at which the acquisition function is maximised
+ACQUISITION_SAMPLES = 2000
+
+
+def _integrand(system, objective):
+    # (op, key) with the objective values[key] * int <op> dt, or int <op> dt
+    # for key None
+    if isinstance(objective, qu.Qobj):
+        return objective, None
+    flux_ops = system._flux_ops()
+    if objective in flux_ops:
+        return flux_ops[objective], objective
+    return system.e_ops[objective], None
+
+
+def _evaluate(template, values, objective, keys=None):
+    # the objective at values and, for keys, its sensitivities
+    system = template.instantiate(values)
+    op, key = _integrand(system, objective)
+    scale = 1 if key is None else values[key]
+    if keys is None:
+        result, _ = system.solve(store_states=False, e_ops={"objective": op})
+        return scale * trapezoid(result.expect["objective"], system.tlist)
+    I, dI = system.sensitivity(op, keys)
+    # d/dp of values[key] * I
+    grad = {p: scale * dI[p] + (I if p == key else 0) for p in keys}
+    return scale * I, grad
+
+
+def _init_worker(template, values, objective):
+    _worker["template"] = template
+    _worker["values"] = values
+    _worker["objective"] = objective
+
+
+def _run(task):
+    overrides, keys = task
+    values = dict(_worker["values"])
+    values.update(overrides)
+    return _evaluate(_worker["template"], values, _worker["objective"], keys)
+
+
+def gradient(
+    template,
+    objective,
+    keys=None,
+    values=None,
+    method="fd",
+    step=1e-2,
+    workers=None,
+    blas_threads=None,
+):
+    """
+    Value and gradient of an integrated objective at values.
+
+    objective is a collapse parameter key, for the number of quantum jumps
+    through its channel, or an e_ops name or operator, for the time integral
+    of its expectation. The gradient is an array ordered as keys (all
+    parameters by default). method="fd" takes central differences with steps
+    of step * max(1, |value|), from 2 * len(keys) + 1 solves on workers
+    processes. method="sensitivity" splits the keys that enter the operators
+    (Omega, Delta, g, Delta_c, decay rates, B) between the workers for forward
+    sensitivity solves, and only takes pulse args by differences.
+    """
+    if method not in ("fd", "sensitivity"):
+        raise ValueError("Unknown gradient method: {}".format(method))
+    values = template.values(values)
+    keys = list(template.keys if keys is None else keys)
+    unknown = set(keys) - set(values)
+    if unknown:
+        raise KeyError("Unknown parameters: {}".format(sorted(unknown)))
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    fd_keys = keys
+    tasks = []
+    if method == "sensitivity":
+        fd_keys = [key for key in keys if key in template.arg_keys]
+        linear = [key for key in keys if key not in template.arg_keys]
+        n = min(workers, len(linear))
+        tasks += [({}, linear[i::n]) for i in range(n)]
+    if not tasks:
+        tasks.append(({}, None))
+    steps = {key: step * max(1, abs(values[key])) for key in fd_keys}
+    for key in fd_keys:
+        tasks.append(({key: values[key] + steps[key]}, None))
+        tasks.append(({key: values[key] - steps[key]}, None))
+
+    workers = max(1, min(workers, len(tasks)))
+    out = parallel_map(
+        _run, tasks, _init_worker, (template, values, objective), workers, blas_threads
+    )
+    _worker.clear()
+    grad = {}
+    n = len(tasks) - 2 * len(fd_keys)
+    for res in out[:n]:
+        if isinstance(res, tuple):
+            grad.update(res[1])
+    value = out[0][0] if isinstance(out[0], tuple) else out[0]
+    for k, key in enumerate(fd_keys):
+        plus, minus = out[n + 2 * k : n + 2 * k + 2]
+        grad[key] = (plus - minus) / (2 * steps[key])
+    return value, np.array([grad[key] for key in keys])
+
+
+def evaluate(
+    template, objective, points, values=None, workers=None, blas_threads=None
+):
+    # the objective at each of points, a list of dicts of parameter values
+    # overriding values, solved in parallel (see gradient for objectives)
+    values = template.values(values)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(points)))
+    tasks = [(dict(point), None) for point in points]
+    out = parallel_map(
+        _run, tasks, _init_worker, (template, values, objective), workers, blas_threads
+    )
+    _worker.clear()
+    return np.array(out)
+
+
+def _posterior(X, y, Xs, length, noise=1e-6):
+    # mean and standard deviation at Xs of a Gaussian process with a squared
+    # exponential kernel, conditioned on the standardised values y at X
+    def kernel(A, B):
+        d2 = ((A[:, None, :] - B[None, :, :]) ** 2).sum(axis=-1)
+        return np.exp(-d2 / (2 * length**2))
+
+    K = kernel(X, X) + noise * np.eye(len(X))
+    cho = la.cho_factor(K, lower=True)
+    Ks = kernel(X, Xs)
+    mean = Ks.T @ la.cho_solve(cho, y)
+    var = 1 - np.sum(Ks * la.cho_solve(cho, Ks), axis=0)
+    return mean, np.sqrt(np.maximum(var, 0))
+
+
+def _length_scale(X, y, noise=1e-6):
+    # isotropic length scale (on the unit cube) of largest marginal likelihood
+    d2 = ((X[:, None, :] - X[None, :, :]) ** 2).sum(axis=-1)
+    best = None
+    for length in np.geomspace(0.05, 2, 12):
+        K = np.exp(-d2 / (2 * length**2)) + noise * np.eye(len(X))
+        try:
+            c, low = la.cho_factor(K, lower=True)
+        except la.LinAlgError:
+            continue
+        fit = y @ la.cho_solve((c, low), y) + 2 * np.log(np.diag(c)).sum()
+        if best is None or fit < best[0]:
+            best = (fit, length)
+    return 0.2 if best is None else best[1]
+
+
+def _acquire(X, y, batch_size, kappa, rng):
+    # a batch of candidates on the unit cube maximising the upper confidence
+    # bound mean + kappa * std. After each pick the surrogate is conditioned
+    # on its own mean there (the "kriging believer"), which shrinks the
+    # uncertainty around it and spreads the batch out
+    y = (y - y.mean()) / (y.std() or 1)
+    length = _length_scale(X, y)
+    best = X[np.argmax(y)]
+    batch = []
+    for _ in range(batch_size):
+        Xs = np.vstack(
+            [
+                rng.random((ACQUISITION_SAMPLES, X.shape[1])),
+                np.clip(
+                    best + 0.05 * rng.standard_normal((100, X.shape[1])), 0, 1
+                ),
+            ]
+        )
+        mean, std = _posterior(X, y, Xs, length)
+        k = np.argmax(mean + kappa * std)
+        batch.append(Xs[k])
+        X = np.vstack([X, Xs[k]])
+        y = np.append(y, mean[k])
+    return np.array(batch)
+
+
+def optimize(
+    template,
+    objective,
+    bounds,
+    values=None,
+    batch_size=None,
+    init_points=None,
+    n_iter=10,
+    maximize=True,
+    kappa=2.576,
+    seed=None,
+    workers=None,
+    blas_threads=None,
+):
+    """
+    Bayesian optimisation of an integrated objective over bounds.
+
+    bounds is a dict of parameter key: (low, high); other parameters keep
+    values (or the template defaults). init_points random candidates (one
+    batch by default) are followed by n_iter batches of batch_size (the
+    number of workers by default) candidates, each acquired from a Gaussian
+    process surrogate and solved concurrently on one pool of workers that
+    holds the template. Returns a scipy OptimizeResult with the best point
+    x (ordered as bounds), its values as params, fun, and every evaluation
+    as xs and funs.
+    """
+    keys = list(bounds)
+    low, high = np.array([bounds[key] for key in keys], dtype=float).T
+    values = template.values(values)
+    unknown = set(keys) - set(values)
+    if unknown:
+        raise KeyError("Unknown parameters: {}".format(sorted(unknown)))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if batch_size is None:
+        batch_size = workers
+    if init_points is None:
+        init_points = batch_size
+    workers = max(1, min(workers, max(batch_size, init_points)))
+    sign = 1 if maximize else -1
+    rng = np.random.default_rng(seed)
+
+    X = np.zeros((0, len(keys)))
+    y = np.zeros(0)
+    with worker_pool(
+        _init_worker, (template, values, objective), workers, blas_threads
+    ) as map_:
+        batch = rng.random((init_points, len(keys)))
+        for it in range(n_iter + 1):
+            if it:
+                batch = _acquire(X, y, batch_size, kappa, rng)
+            points = low + batch * (high - low)
+            tasks = [(dict(zip(keys, x)), None) for x in points]
+            X = np.vstack([X, batch])
+            y = np.append(y, sign * np.real(map_(_run, tasks)))
+    _worker.clear()
+
+    xs = low + X * (high - low)
+    best = np.argmax(y)
+    return OptimizeResult(
+        x=xs[best],
+        params=dict(zip(keys, xs[best])),
+        fun=sign * y[best],
+        xs=xs,
+        funs=sign * y,
+        nfev=len(y),
+        nit=n_iter,
+        success=True,
+    )
@@ -34,7 +34,7 @@ params["zeeman"] = False
 
 atom = AtomSystem(levels, lasers, params, decays=decays, cavities=[cavity])
 
-result, e_ops = atom.solve()
+result, e_ops = atom.solve(flux=True)
 # print(result.states[-1])
 tlist = atom.tlist
 
@@ -46,57 +46,18 @@ plt.legend()
 plt.show()
 
 
-eff = (
-    2
-    * cavity.kappa
-    * sum(qu.expect(result.states, e_ops["n"]))
-    * 100
-    * (params["t_max"] / params["n_step"])
-)
+eff = result.flux[cavity.name + "kappa"][-1] * 100
 print(eff)
 
-g, i, e = atom.astates
-proj_g = atom.projectors["g"][0]
-proj_i = atom.projectors["i"][0]
-proj_e = atom.projectors["e"][0]
-Aops = atom.Aops
-s1 = Aops["gi"][0]
-s2 = Aops["ie"][0]
-a = atom.a
-
-# c1, c2 = atom.c_ops
-
-ca = atom.c_ops[-1]
-
-H = atom.H
-K = qu.liouvillian(atom.H) # - qu.to_super(ca)
-# Kt = qu.liouvillian(atom.HL_t[0][0])
-# K = [K0, [Kt, gaussian]]
-K = atom.H
-rhototal = [[0 for _ in tlist] for _ in tlist]
-result = qu.mesolve(K, atom.rho0, tlist)
-rho_pre_emission = result.states
-psi_cav_0 = cavity.states[0]
-proj_0 = qu.tensor(g, qu.basis(2,0)).proj()
-# print(proj_0)
-# print(rho_pre_emission[0])
-# print(ca*rho_pre_emission[0])
-
-for tL in range(len(tlist)):
-    result = qu.mesolve(K, a * rho_pre_emission[tL], tlist[tL:], c_ops=[])
-    rho_post_tL = result.states
-    for tR in range(tL, len(tlist)):
-        n = tR - tL
-        result = qu.mesolve(K, rho_post_tL[n] * a.dag(), tlist[tR:], c_ops=[])
-        rhofinal = result.states[-1]
-        matelement = qu.expect(proj_0, rhofinal)
-        rhototal[tR][tL] = np.conjugate(matelement)
-        rhototal[tL][tR] = matelement
+# two-time photon density matrix rho(t1, t2) = 2 kappa <a^dag(t2) a(t1)>,
+# from the quantum regression theorem
+G = atom.correlation(atom.a.dag(), atom.a)
+rhototal = 2 * cavity.kappa * (G + np.triu(G, 1).conj().T)
 
 diagonal = np.diagonal(rhototal)
 P1 = np.trapz(diagonal, tlist)
 print(P1)
 Purity = np.trapz(
-    [np.trapz(np.square(rhototal[row]), tlist) for row in range(len(tlist))], tlist
+    [np.trapz(np.abs(rhototal[row]) ** 2, tlist) for row in range(len(tlist))], tlist
 ) / (P1**2)
 print(Purity)
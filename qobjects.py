@@ -136,8 +136,7 @@ class Laser(Coupling):
     def Omega(self, new_Omega):
         self._Omega = new_Omega
         if self.system:
-            self.system._interactions()
-            self.system._hamiltonian()
+            self.system._update()
 
     @property
     def Delta(self):
@@ -147,14 +146,28 @@ class Laser(Coupling):
     def Delta(self, new_Delta):
         self._Delta = new_Delta
         if self.system:
-            self.system._hamiltonian()
+            self.system._update()
+
+    @property
+    def lw(self):
+        return self._lw
+
+    @lw.setter
+    def lw(self, val):
+        self._lw = val
+        if self.system:
+            if self.name + "lw" in self.system.parameters:
+                self.system._update()
+            else:
+                # the dephasing operator only exists for lasers with a linewidth
+                self.system.build_hamiltonian()
 
     def create_dict(self):
         d = {
             "L1": self.L1,
             "L2": self.L2,
             "Omega": self.Omega,
-            "Delta": self.Detla,
+            "Delta": self.Delta,
             "lw": self.lw,
             "k": self.k,
             "S": self.S,
@@ -177,7 +190,7 @@ class Decay(Coupling):
     def gamma(self, val):
         self._gamma = val
         if self.system:
-            self.system._decays()
+            self.system._update()
 
     def create_dict(self):
         d = {
@@ -220,13 +233,26 @@ class Cavity(Coupling):
             self.pol = [1, 0, 1]
         else:
             self.pol = pol
-        self.N = N
+        self.n = n
+        self.n2 = n2
         self.modes = modes
-        self.states = [qu.basis(self.N, i) for i in range(self.N)]
-        if modes == 1:
-            self.psi0 = qu.basis(self.N, n)
-        elif modes == 2:
-            self.psi0 = qu.tensor(qu.basis(self.N, n), qu.basis(self.N, n2))
+        self.N = N
+
+    @property
+    def N(self):
+        return self._N
+
+    @N.setter
+    def N(self, val):
+        # the Fock space truncation fixes the dimensions, so the system is rebuilt
+        self._N = val
+        self.states = [qu.basis(val, i) for i in range(val)]
+        if self.modes == 1:
+            self.psi0 = qu.basis(val, self.n)
+        elif self.modes == 2:
+            self.psi0 = qu.tensor(qu.basis(val, self.n), qu.basis(val, self.n2))
+        if self.system:
+            self.system.build_hamiltonian()
 
     @property
     def g(self):
@@ -236,8 +262,17 @@ class Cavity(Coupling):
     def g(self, val):
         self._g = val
         if self.system:
-            self.system._interactions()
-            self.system._hamiltonian()
+            self.system._update()
+
+    @property
+    def kappa(self):
+        return self._kappa
+
+    @kappa.setter
+    def kappa(self, val):
+        self._kappa = val
+        if self.system:
+            self.system._update()
 
     @property
     def Delta(self):
@@ -247,14 +282,14 @@ class Cavity(Coupling):
     def Delta(self, new_Delta):
         self._Delta = new_Delta
         if self.system:
-            self.system._hamiltonian()
+            self.system._update()
 
     def create_dict(self):
         d = {
             "L1": self.L1,
             "L2": self.L2,
-            "g": self.Omega,
-            "Delta": self.Detla,
+            "g": self.g,
+            "Delta": self.Delta,
             "kappa": self.kappa,
             "k": self.k,
             "pol": self.pol,
@@ -262,5 +297,7 @@ class Cavity(Coupling):
             "args": self.args,
             "N": self.N,
             "n": self.n,
+            "n2": self.n2,
+            "modes": self.modes,
         }
         return d
@@ -4,8 +4,11 @@ Created on Thu Jan 11 21:44:50 2018
 
 @author: twalk
 """
+import json
 import numpy as np
 
+_cg_tables = {}
+
 
 def murelj(Jg, Je):
     import numpy as np
@@ -33,6 +36,52 @@ def murelj(Jg, Je):
         return Am, A0, Ap
 
 
+def cg_table(Jg, Je, q):
+    # table = cg_table(Jg, Je, q) returns the (2Jg+1) x (2Je+1) array of
+    # Clebsch-Gordan coefficients <Jg mg; 1 q | Je me> for polarisation q.
+    # Tables are memoised per (Jg, Je, q) so each is only computed once per
+    # process, and can be persisted with save_cg_tables/load_cg_tables.
+    key = (float(Jg), float(Je), int(q))
+    if key not in _cg_tables:
+        import qutip as qu
+
+        Mg = np.arange(-Jg, Jg + 1)
+        Me = np.arange(-Je, Je + 1)
+        table = np.zeros([len(Mg), len(Me)])
+        # only me = mg + q is allowed, so fill that diagonal of the table
+        rows = np.arange(len(Mg))
+        cols = np.rint(Mg + q + Je).astype(int)
+        allowed = (cols >= 0) & (cols < len(Me))
+        if abs(Jg - Je) > 1 or Jg + Je < 1:
+            # dipole transition forbidden by the triangle rule
+            allowed[:] = False
+        for i, j in zip(rows[allowed], cols[allowed]):
+            table[i, j] = qu.clebsch(Jg, 1, Je, Mg[i], q, Me[j])
+        table.setflags(write=False)
+        _cg_tables[key] = table
+    return _cg_tables[key]
+
+
+def save_cg_tables(path):
+    # write all memoised Clebsch-Gordan tables to a json file
+    tables = {
+        "{},{},{}".format(*key): table.tolist() for key, table in _cg_tables.items()
+    }
+    with open(path, "w") as f:
+        json.dump(tables, f)
+
+
+def load_cg_tables(path):
+    # pre-populate the memoised Clebsch-Gordan tables from a json file
+    with open(path, "r") as f:
+        tables = json.load(f)
+    for key, table in tables.items():
+        Jg, Je, q = key.split(",")
+        table = np.array(table, dtype=float)
+        table.setflags(write=False)
+        _cg_tables[(float(Jg), float(Je), int(q))] = table
+
+
 def zeemanFS(J, S, L, B, scaling_factor):
     #
     #  w = zeeman(J,S,L,F,I,B) calculates the angular frequency shift
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed on-disk cache of solve results.
+
+An entry is keyed by the SHA-256 of the canonical JSON of everything that
+fixes a result: the system dict, the parameter values, the solver options and
+the versions of the cache format, qutip and numpy. Changing any of them gives
+a new key, so stale entries are never read, only evicted. Entries are
+compressed .npz files of the expectation arrays (and the states, if the solve
+kept them); once the directory grows beyond max_bytes the least recently used
+entries are deleted.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import qutip as qu
+
+# next to the code rather than in the working directory, so that scripts and
+# the GUI share one cache wherever they are run from
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+# bump whenever a change to the solvers changes their results
+CACHE_VERSION = 1
+MAX_BYTES = 256 * 2**20
+
+
+def _encode(obj):
+    # JSON form of the numpy and qutip values found in system dicts and options
+    if isinstance(obj, qu.Qobj):
+        # hash the sparse arrays rather than densifying large operators
+        data = obj.data if obj.data.has_sorted_indices else obj.data.sorted_indices()
+        sha = hashlib.sha256()
+        for arr in (data.data, data.indices, data.indptr):
+            sha.update(np.ascontiguousarray(arr).tobytes())
+        return {"dims": obj.dims, "sha256": sha.hexdigest()}
+    if isinstance(obj, np.ndarray):
+        if np.iscomplexobj(obj):
+            return {"real": obj.real.tolist(), "imag": obj.imag.tolist()}
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return _encode(obj.item()) if np.iscomplexobj(obj) else obj.item()
+    if isinstance(obj, complex):
+        return [obj.real, obj.imag]
+    raise TypeError("Cannot hash {}".format(type(obj).__name__))
+
+
+def canonical(obj):
+    # JSON with sorted keys, so equal dicts give equal strings
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), default=_encode)
+
+
+def digest(*parts):
+    versions = [CACHE_VERSION, qu.__version__, np.__version__]
+    return hashlib.sha256(canonical([versions, *parts]).encode()).hexdigest()
+
+
+def _named(prefix, values, arrays, meta):
+    # store a dict of arrays under numbered keys, as names may contain "/"
+    meta[prefix] = list(values)
+    for k, v in enumerate(values.values()):
+        arrays["{}_{}".format(prefix, k)] = np.asarray(v)
+
+
+def _unnamed(prefix, arrays, meta):
+    return {
+        name: arrays["{}_{}".format(prefix, k)] for k, name in enumerate(meta[prefix])
+    }
+
+
+class ResultCache:
+    """
+    Directory of cached results, addressed by key(...) of their inputs.
+
+    Instances only hold the path, size bound and a running size estimate, so
+    they can be passed to worker processes; entries are written atomically,
+    so workers can share a directory. The directory is only rescanned for
+    eviction once the estimate exceeds max_bytes, so writes from other
+    processes are only accounted for by their own evictions or an explicit
+    evict(), as sweeps do when they finish.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # bytes in the directory at the last scan plus those written since
+        self._bytes = None
+
+    def key(self, *parts):
+        return digest(*parts)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def load(self, key):
+        # dict of arrays stored under key, or None
+        file = self._file(key)
+        try:
+            with np.load(file) as data:
+                arrays = dict(data)
+        except (OSError, ValueError):
+            return None
+        try:
+            # the access time of an entry is its modification time
+            os.utime(file)
+        except OSError:
+            pass
+        return arrays
+
+    def save(self, key, arrays):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        file = self._file(key)
+        os.replace(tmp, file)
+        if self._bytes is not None:
+            self._bytes += os.path.getsize(file)
+        if self._bytes is None or self._bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # delete the least recently used entries beyond max_bytes
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".npz"):
+                    os.remove(entry.path)
+        self._bytes = 0
+
+    def get_result(self, key):
+        # the qutip Result stored by put_result, or None
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        meta = json.loads(str(arrays["meta"]))
+        result = qu.solver.Result()
+        result.solver = meta["solver"]
+        result.times = arrays["times"]
+        result.expect = _unnamed("expect", arrays, meta)
+        result.num_expect = len(result.expect)
+        for name in ("expect_error", "flux"):
+            if name in meta:
+                setattr(result, name, _unnamed(name, arrays, meta))
+        if "sample_times" in arrays:
+            result.sample_times = arrays["sample_times"]
+        if "states" in arrays:
+            result.states = [qu.Qobj(s, dims=meta["dims"]) for s in arrays["states"]]
+        result.final_state = None
+        if "final_state" in arrays:
+            result.final_state = qu.Qobj(arrays["final_state"], dims=meta["dims"])
+        for name, value in meta["attrs"].items():
+            setattr(result, name, value)
+        result.cached = True
+        return result
+
+    def put_result(self, key, result):
+        arrays = {"times": np.asarray(result.times)}
+        meta = {"solver": result.solver, "attrs": {}}
+        _named("expect", result.expect, arrays, meta)
+        for name in ("expect_error", "flux"):
+            if hasattr(result, name):
+                _named(name, getattr(result, name), arrays, meta)
+        if hasattr(result, "sample_times"):
+            arrays["sample_times"] = result.sample_times
+        state = result.final_state
+        if state is not None:
+            meta["dims"] = state.dims
+            arrays["final_state"] = state.full()
+        if result.states:
+            meta["dims"] = result.states[0].dims
+            arrays["states"] = np.array([s.full() for s in result.states])
+        for name in ("ntraj", "blocks", "N"):
+            if hasattr(result, name):
+                meta["attrs"][name] = getattr(result, name)
+        arrays["meta"] = np.array(canonical(meta))
+        self.save(key, arrays)
+
+    def get_state(self, key):
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        return qu.Qobj(arrays["state"], dims=json.loads(str(arrays["dims"])))
+
+    def put_state(self, key, state):
+        self.save(key, {"state": state.full(), "dims": np.array(canonical(state.dims))})
@@ -0,0 +1,853 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Solver methods shared by AtomSystem and the systems instantiated from a
+compiled SystemTemplate.
+
+Classes using SolverMixin provide params, rho0, e_ops, args, the operator
+terms H_terms, H_t_terms and c_terms, a _rho() method that resets rho0, a
+_fingerprint() of the system and its parameter values for result caches and
+a _cache dict that is shared by all systems with the same operator terms.
+"""
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import qutip as qu
+import scipy.linalg as la
+from scipy.integrate import cumulative_trapezoid, trapezoid
+import scipy.sparse as sp
+import scipy.sparse.csgraph as csgraph
+import scipy.sparse.linalg as spla
+from qutip.ui.progressbar import BaseProgressBar
+import operators as ops
+from H_funcs import compile_coeff, segments
+from result_cache import ResultCache
+
+# largest Liouville space dimension propagated with a dense expm
+DENSE_EXPM_DIM = 256
+# number of dense propagators kept per compiled set of operator terms
+PROPAGATOR_CACHE_SIZE = 16
+# largest Liouville space dimension, and eigenvector condition number, for
+# which solve(method="eig") uses the eigendecomposition of L
+EIG_MAX_DIM = 400
+EIG_MAX_COND = 1e8
+# smallest block that solve(method="blocks") solves in parallel
+BLOCK_PARALLEL_DIM = 64
+
+
+def _block_ode(H, v, tlist, args):
+    # states of one block of the state vector over tlist, from sesolve of the
+    # "Hamiltonian" H = iG; qutip's ODE solver (scipy's ZVODE) is not
+    # thread-safe, so blocks are only integrated in parallel by processes
+    res = qu.sesolve(
+        H,
+        qu.Qobj(v[:, None]),
+        tlist,
+        options=qu.Options(normalize_output=False),
+        args=args,
+    )
+    return np.hstack([state.full() for state in res.states])
+
+
+def _correlation_row(L, X, times, row, args):
+    # tr[A X(t)] for the operator X evolved over times, with row the
+    # row-major A; one row of SolverMixin.correlation
+    res = qu.mesolve(L, X, times, options=qu.Options(store_states=True), args=args)
+    vectors = [qu.operator_to_vector(state).full().ravel() for state in res.states]
+    return np.array(vectors) @ row
+
+
+def _snap(tlist, times, rtol=1e-6):
+    # times moved onto the nearest point of the uniform tlist when they are
+    # within rtol steps of it, so that merging them adds no near-duplicates
+    times = np.asarray(times, dtype=float)
+    if len(tlist) < 2:
+        return times
+    idx = np.clip(np.searchsorted(tlist, times), 1, len(tlist) - 1)
+    left, right = tlist[idx - 1], tlist[idx]
+    nearest = np.where(times - left < right - times, left, right)
+    tol = rtol * (tlist[1] - tlist[0])
+    return np.where(np.abs(nearest - times) <= tol, nearest, times)
+
+
+class _StateSampler:
+    # e_ops callback keeping the states at the chosen steps of tlist, so the
+    # integrator never has to store the states in between
+    def __init__(self, steps):
+        self.steps = set(steps)
+        self.step = 0
+        self.times = []
+        self.states = []
+
+    def __call__(self, t, state):
+        if self.step in self.steps:
+            self.times.append(t)
+            self.states.append(state)
+        self.step += 1
+        return 0
+
+
+class _Functionals:
+    # e_ops callback recording tr(A X_k) for each of the column-stacked
+    # density matrices X_k stacked in the state vector, with row the
+    # row-major A
+    def __init__(self, row):
+        self.row = row
+        self.values = []
+
+    def __call__(self, t, state):
+        X = state.full().reshape(-1, len(self.row))
+        self.values.append(X @ self.row)
+        return 0
+
+
+class _Recorder:
+    # expectation values and states of a solve from state vectors v, either
+    # kets or column-stacked density matrices, collected into a qutip Result
+    def __init__(self, solver, tlist, state, e_ops, store_states):
+        self.result = qu.solver.Result()
+        self.result.solver = solver
+        self.result.times = tlist
+        self.result.num_expect = len(e_ops)
+        self.dims = state.dims
+        self.ket = state.isket
+        self.n = state.shape[0]
+        self.e_ops = e_ops
+        self.store_states = store_states
+        self.expect = [[] for _ in e_ops]
+        # <psi|A|psi>, or tr(A rho) as the row-major A dotted into the
+        # column-stacked rho
+        self.ops = {
+            k: op.full() if self.ket else op.full().ravel()
+            for k, op in enumerate(e_ops)
+            if isinstance(op, qu.Qobj)
+        }
+
+    def vector(self, state):
+        if self.ket:
+            return state.full().ravel()
+        return qu.operator_to_vector(state).full().ravel()
+
+    def full(self, v, index=None):
+        if index is None:
+            return v
+        out = np.zeros(self.n if self.ket else self.n**2, dtype=complex)
+        out[index] = v
+        return out
+
+    def state(self, v):
+        if self.ket:
+            return qu.Qobj(v[:, None], dims=self.dims)
+        return qu.Qobj(v.reshape((self.n, self.n), order="F"), dims=self.dims)
+
+    def __call__(self, t, v):
+        self.extend([t], v[:, None])
+
+    def extend(self, times, V, index=None):
+        # record the columns of V, the states at times; with index, V only
+        # holds these components of the state vectors and the rest are zero
+        for k, op in self.ops.items():
+            if index is not None:
+                op = op[np.ix_(index, index)] if self.ket else op[index]
+            if self.ket:
+                self.expect[k].extend(np.einsum("it,it->t", V.conj(), op @ V))
+            else:
+                self.expect[k].extend(op @ V)
+        if self.store_states or len(self.ops) < len(self.e_ops):
+            for t, v in zip(times, V.T):
+                rho = self.state(self.full(v, index))
+                for k, op in enumerate(self.e_ops):
+                    if k not in self.ops:
+                        self.expect[k].append(op(t, rho))
+                if self.store_states:
+                    self.result.states.append(rho)
+
+    def finish(self, v):
+        hermitian = [k in self.ops and op.isherm for k, op in enumerate(self.e_ops)]
+        self.result.expect = [
+            np.real(values) if herm else np.array(values)
+            for herm, values in zip(hermitian, self.expect)
+        ]
+        self.result.final_state = self.state(v)
+        return self.result
+
+
+class SolverMixin:
+    def _evaluate(self, values):
+        # evaluate H, HL_t and c_ops for a dict of parameter values
+        self._values = values
+        self._L = None
+        self.H = self.H_terms(values)
+        self.HL_t = [[H_t(values), func] for H_t, func in self.H_t_terms]
+        self.c_ops = [
+            np.sqrt(factor * values[key]) * c_op for c_op, key, factor in self.c_terms
+        ]
+
+    def _superoperator_terms(self):
+        # commutator and dissipator superoperators for every operator term,
+        # built once and weighted by the same coefficients as H and c_ops
+        if "L_terms" not in self._cache:
+            dims = self.H_terms.dims
+            L_terms = ops.ParametricOperator([dims, dims])
+            for (key, factor, conj), op in zip(self.H_terms.terms, self.H_terms.ops):
+                L_terms.add(-1j * (qu.spre(op) - qu.spost(op)), key, factor, conj)
+            for c_op, key, factor in self.c_terms:
+                L_terms.add(qu.lindblad_dissipator(c_op), key, factor)
+            L_t_terms = []
+            for H_t, func in self.H_t_terms:
+                L_t = ops.ParametricOperator([dims, dims])
+                for (key, factor, conj), op in zip(H_t.terms, H_t.ops):
+                    L_t.add(-1j * (qu.spre(op) - qu.spost(op)), key, factor, conj)
+                L_t_terms.append((L_t, func))
+            self._cache["L_terms"] = L_terms
+            self._cache["L_t_terms"] = L_t_terms
+        return self._cache["L_terms"], self._cache["L_t_terms"]
+
+    def liouvillian(self):
+        # Liouvillian superoperator as [L, *L_t], in the format of [H, *HL_t]
+        if self._L is None:
+            L_terms, L_t_terms = self._superoperator_terms()
+            self._L = [L_terms(self._values)]
+            self._L += [[L_t(self._values), func] for L_t, func in L_t_terms]
+        return self._L
+
+    def steady_state(self, method="direct", cache=None, **kwargs):
+        # solve L rho = 0 directly instead of evolving to equilibrium.
+        # method is "direct" (sparse LU) or one of qutip's iterative solvers,
+        # "iterative-gmres", "iterative-lgmres" or "iterative-bicgstab";
+        # kwargs (tol, maxiter, x0, use_precond, ...) go to qu.steadystate.
+        # cache (a ResultCache, or True for the default one) is looked up
+        # before solving; the initial guess x0 is not part of its key
+        if self.HL_t:
+            raise ValueError("Steady state requires a time-independent system")
+        if method.startswith("iterative"):
+            # unpreconditioned Krylov solvers rarely converge for these systems
+            kwargs.setdefault("use_precond", True)
+        if cache is True:
+            cache = ResultCache()
+        cache_key = None
+        if cache:
+            options = {k: v for k, v in kwargs.items() if k != "x0"}
+            options = {"steady_state": method, "kwargs": options}
+            cache_key = self._cache_key(cache, options)
+            self.steady = cache.get_state(cache_key) if cache_key else None
+            if self.steady is not None:
+                return self.steady
+        L = self.liouvillian()[0]
+        self.steady = qu.steadystate(L, method=method, **kwargs)
+        if cache_key:
+            cache.put_state(cache_key, self.steady)
+        return self.steady
+
+    def spectrum(self, wlist, a_op, b_op, solver="es"):
+        # spectrum of <A(tau)B(0)> in the steady state, from the cached L
+        if self.HL_t:
+            raise ValueError("Spectrum requires a time-independent system")
+        L = self.liouvillian()[0]
+        return qu.spectrum(L, wlist, [], a_op, b_op, solver=solver)
+
+    def correlation(self, a_op, b_op, rho0=None, workers=None):
+        # two-time correlations G[i, j] = <a_op(t_j) b_op(t_i)> for t_j >= t_i
+        # on tlist (zero for t_j < t_i), from the quantum regression theorem
+        # tr[a_op exp(L (t_j - t_i)) (b_op rho(t_i))]. A time-independent L is
+        # applied through its cached eigendecomposition or propagator for all
+        # pairs at once; otherwise one mesolve per t_i runs on workers processes
+        self.tlist = np.linspace(0, self.params["t_max"], self.params["n_step"])
+        tlist = self.tlist
+        if rho0 is None:
+            self._rho()
+            rho0 = self.rho0
+        rho0 = qu.ket2dm(rho0) if rho0.isket else rho0
+        row = a_op.full().ravel()
+        pre = qu.spre(b_op).data
+        T = len(tlist)
+        G = np.zeros((T, T), dtype=complex)
+        if self.HL_t:
+            L = self.liouvillian()
+            states = qu.mesolve(L, rho0, tlist, args=self.args).states
+            tasks = (
+                [L] * T,
+                [b_op * state for state in states],
+                [tlist[i:] for i in range(T)],
+                [row] * T,
+                [self.args] * T,
+            )
+            if (workers or os.cpu_count()) == 1:
+                rows = map(_correlation_row, *tasks)
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    rows = list(pool.map(_correlation_row, *tasks))
+            for i, values in enumerate(rows):
+                G[i, i:] = values
+            return G
+        v = qu.operator_to_vector(rho0).full().ravel()
+        dt = np.round(tlist[1] - tlist[0], 12)
+        tau = np.arange(T) * dt
+        eig = self._eigensystem(False)
+        if eig is not None:
+            # G[i, i + k] = sum_m (a V)_m exp(w_m tau_k) (V^-1 b rho(t_i))_m
+            w, V, lu = eig
+            E = np.exp(np.outer(w, tau))
+            X = pre @ (V @ (E * la.lu_solve(lu, v)[:, None]))
+            Gk = ((row @ V)[:, None] * E).T @ la.lu_solve(lu, X)
+            i, k = np.triu_indices(T)
+            k = k - i
+            G[i, i + k] = Gk[k, i]
+            return G
+        L = self.liouvillian()[0]
+        if L.shape[0] <= DENSE_EXPM_DIM:
+            P = self._propagator(L.full, (), dt, False)
+
+            def step(Y):
+                return P @ Y
+
+        else:
+            Ldt = (L.data * dt).tocsc()
+
+            def step(Y):
+                return spla.expm_multiply(Ldt, Y)
+
+        states = [v]
+        for _ in range(T - 1):
+            states.append(step(states[-1]))
+        Y = pre @ np.array(states).T
+        for k in range(T):
+            G[np.arange(T - k), np.arange(k, T)] = row @ Y
+            if k < T - 1:
+                Y = step(Y[:, : T - k - 1])
+        return G
+
+    def _flux_ops(self):
+        # sum of factor * c^dag c over the collapse terms of each parameter
+        # key; <op> times the parameter value is the rate of quantum jumps
+        # through that channel, e.g. photons emitted by a Decay or the cavity
+        if "flux_ops" not in self._cache:
+            flux = {}
+            for c_op, key, factor in self.c_terms:
+                op = factor * c_op.dag() * c_op
+                flux[key] = flux[key] + op if key in flux else op
+            self._cache["flux_ops"] = flux
+        return self._cache["flux_ops"]
+
+    def sensitivity(self, op, keys, rho0=None):
+        # I = int tr(op rho(t)) dt over tlist, by the trapezoidal rule, and
+        # the derivatives dI/dp for the parameter keys p from one forward
+        # sensitivity solve: s_p = d rho/dp follows ds_p/dt = L s_p + dL/dp rho
+        # from s_p(0) = 0, and is integrated together with rho under the
+        # block lower-triangular generator [[L, 0], [dL/dp, L]], as sesolve of
+        # the "Hamiltonian" iG. Pulse args do not enter the operators and
+        # have no sensitivity; take their derivatives by finite differences
+        unknown = [k for k in keys if k not in self._values or k in self.args]
+        if unknown:
+            raise ValueError("No sensitivity for parameters: {}".format(unknown))
+        self.tlist = np.linspace(0, self.params["t_max"], self.params["n_step"])
+        if rho0 is None:
+            self._rho()
+            rho0 = self.rho0
+        rho0 = qu.ket2dm(rho0) if rho0.isket else rho0
+        L_terms, L_t_terms = self._superoperator_terms()
+        L, *L_t = self.liouvillian()
+        m = len(keys)
+
+        def augmented(G, terms):
+            blocks = [[None] * (m + 1) for _ in range(m + 1)]
+            for i in range(m + 1):
+                blocks[i][i] = G.data
+            for i, key in enumerate(keys):
+                blocks[i + 1][0] = terms.derivative(key).data
+            return qu.Qobj(1j * sp.bmat(blocks, format="csr"))
+
+        H = [augmented(L, L_terms)]
+        for (G, func), (terms, _) in zip(L_t, L_t_terms):
+            H.append([augmented(G, terms), func])
+        v = qu.operator_to_vector(rho0).full().ravel()
+        v = np.concatenate([v, np.zeros(m * len(v), dtype=complex)])
+        functionals = _Functionals(op.full().ravel())
+        qu.sesolve(
+            H,
+            qu.Qobj(v[:, None]),
+            self.tlist,
+            e_ops=[functionals],
+            options=qu.Options(normalize_output=False),
+            args=self.args,
+        )
+        values = np.array(functionals.values)
+        if op.isherm:
+            values = values.real
+        integrals = trapezoid(values, self.tlist, axis=0)
+        return integrals[0], dict(zip(keys, integrals[1:]))
+
+    def _cache_key(self, cache, options):
+        # key of a result for options in cache, or None if an option (like
+        # an e_ops callback) cannot be hashed
+        try:
+            return cache.key(self._fingerprint(), options)
+        except TypeError:
+            return None
+
+    def _expect_ops(self, e_ops):
+        # e_ops as a dict of name: operator, from True (all of self.e_ops),
+        # a list of e_ops names or a dict
+        if e_ops is True:
+            return dict(self.e_ops)
+        if isinstance(e_ops, dict):
+            return dict(e_ops)
+        return {name: self.e_ops[name] for name in e_ops}
+
+    def _compiled(self, H_t, coefficients):
+        # [[op, func]] with the pulse callbacks replaced by compiled
+        # coefficients: "string", "array" (cubic spline interpolation on
+        # tlist) or "step" (arrays held constant between points of tlist).
+        # Sampled pulses are only as accurate as n_step resolves them, and the
+        # gate edges of a pulse are smoothed over one step
+        kind = "string" if coefficients == "string" else "array"
+        return [
+            [op, compile_coeff(func, self.args, self.tlist, kind)] for op, func in H_t
+        ]
+
+    def _pulse_segments(self, t_start, t_end):
+        # split [t_start, t_end] at the pulse edges into (t_a, t_b, coeffs),
+        # where coeffs holds the constant value of every pulse on the segment
+        # or is None if a pulse varies on it
+        pulses = [segments(func, self.args) for _, func in self.H_t_terms]
+        edges = {t_start, t_end}
+        for pieces in pulses:
+            for a, b, _ in pieces:
+                edges.update(t for t in (a, b) if t_start < t < t_end)
+        edges = sorted(edges)
+        out = []
+        for a, b in zip(edges[:-1], edges[1:]):
+            t = (a + b) / 2
+            coeffs = [
+                next((v for start, end, v in pieces if start <= t < end), 0)
+                for pieces in pulses
+            ]
+            out.append((a, b, None if None in coeffs else coeffs))
+        return out
+
+    def is_coherent(self):
+        # True if every collapse operator has a zero rate, so that pure
+        # states stay pure
+        return all(factor * self._values[key] == 0 for _, key, factor in self.c_terms)
+
+    def _generator(self, coherent):
+        # [G, *G_t] with d/dt of the state vector = G v: -iH on kets for
+        # coherent solves, L on density matrices otherwise
+        if coherent:
+            return [-1j * self.H] + [[-1j * H_t, func] for H_t, func in self.HL_t]
+        return self.liouvillian()
+
+    def _propagator(self, G, coeffs, dt, coherent):
+        # exp(G dt) for the generator G of a segment with constant pulse
+        # values coeffs, cached by parameter values, pulse values and dt so
+        # that repeated solves only multiply by it
+        cache = self._cache.setdefault("propagators", OrderedDict())
+        key = (tuple(sorted(self._values.items())), tuple(coeffs), dt, coherent)
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = la.expm(G() * dt)
+            if len(cache) > PROPAGATOR_CACHE_SIZE:
+                cache.popitem(last=False)
+        return cache[key]
+
+    def _piecewise(self, rho0, e_ops, options):
+        # mesolve for piecewise-constant pulses: segments on which every pulse
+        # is constant are advanced with exp(G dt), as a cached dense
+        # propagator (see _propagator) or with expm_multiply for large
+        # systems, and only segments on which a pulse varies are integrated.
+        # A time-independent system is a single constant segment. Kets
+        # without dissipation are propagated as kets, with exp(-iH dt)
+        coherent = rho0.isket and self.is_coherent()
+        G, *G_t = self._generator(coherent)
+        rho = rho0 if coherent or not rho0.isket else qu.ket2dm(rho0)
+        tlist = self.tlist
+        solver = "piecewise-ket" if coherent else "piecewise"
+        record = _Recorder(solver, tlist, rho, e_ops, options.store_states)
+        v = record.vector(rho)
+        t = tlist[0]
+        record(t, v)
+        for a, b, coeffs in self._pulse_segments(tlist[0], tlist[-1]):
+            points = tlist[(tlist > a) & (tlist <= b)]
+            if coeffs is None:
+                times = np.unique(np.concatenate([[t], points, [b]]))
+                res = qu.mesolve(
+                    [self.H, *self.HL_t] if coherent else self.liouvillian(),
+                    record.state(v),
+                    times,
+                    options=qu.Options(store_states=True),
+                    args=self.args,
+                )
+                for time_, rho in zip(times[1:], res.states[1:]):
+                    v = record.vector(rho)
+                    if time_ in points:
+                        record(time_, v)
+                t = b
+                continue
+            Gs = G
+            for c, (G_k, _) in zip(coeffs, G_t):
+                if c:
+                    Gs = Gs + c * G_k
+            # steps to each point in the segment and on to its end, rounded so
+            # that equal steps share a propagator
+            dts = np.round(np.diff(np.concatenate([[t], points, [b]])), 12)
+            if Gs.shape[0] <= DENSE_EXPM_DIM:
+                props = {
+                    dt: self._propagator(Gs.full, coeffs, dt, coherent)
+                    for dt in set(dts)
+                    if dt > 0
+                }
+
+                def step(v, dt):
+                    return props[dt] @ v
+
+            else:
+                Gs = Gs.data.tocsc()
+
+                def step(v, dt):
+                    return spla.expm_multiply(Gs * dt, v)
+
+            # points closer than the rounding are recorded without a step
+            for p, dt in zip(points, dts):
+                if dt > 0:
+                    v = step(v, dt)
+                record(p, v)
+            if dts[-1] > 0:
+                v = step(v, dts[-1])
+            t = b
+        return record.finish(v)
+
+    def _eigensystem(self, coherent):
+        # eigenvalues w, eigenvectors and LU factors of the eigenvectors of
+        # the dense generator (see _generator), cached for the current
+        # parameter values; None if it is too large or too close to defective
+        # for the eigenbasis to be accurate
+        key = (tuple(sorted(self._values.items())), coherent)
+        cached = self._cache.get("eig")
+        if cached is None or cached[0] != key:
+            eig = None
+            if coherent:
+                E, V = la.eigh(self.H.full())
+                eig = (-1j * E, V, la.lu_factor(V))
+            else:
+                L = self.liouvillian()[0]
+                if L.shape[0] <= EIG_MAX_DIM:
+                    w, V = la.eig(L.full())
+                    if np.linalg.cond(V) < EIG_MAX_COND:
+                        eig = (w, V, la.lu_factor(V))
+            self._cache["eig"] = cached = (key, eig)
+        return cached[1]
+
+    def _eig(self, rho0, e_ops, options):
+        # rho(t) = V exp(w t) V^-1 rho0 for all of tlist at once, from the
+        # eigendecomposition of a time-independent L, or of H for kets
+        # without dissipation; None if it cannot be used, and solve falls
+        # back to mesolve
+        coherent = rho0.isket and self.is_coherent()
+        eig = None if self.HL_t else self._eigensystem(coherent)
+        if eig is None:
+            return None
+        w, V, lu = eig
+        rho = rho0 if coherent or not rho0.isket else qu.ket2dm(rho0)
+        tlist = self.tlist
+        record = _Recorder(
+            "eig-ket" if coherent else "eig", tlist, rho, e_ops, options.store_states
+        )
+        c = la.lu_solve(lu, record.vector(rho))
+        states = V @ (np.exp(np.outer(w, tlist - tlist[0])) * c[:, None])
+        record.extend(tlist, states)
+        return record.finish(states[:, -1])
+
+    def _blocks(self, G, v0):
+        # independent blocks of the state vector v0 under d/dt v = G v, for
+        # G = [G, *G_t]: the components reachable from the support of v0
+        # through the sparsity pattern of G (all others stay zero), split
+        # into connected components. Conserved quantities, like the
+        # excitation number of Jaynes-Cummings couplings, show up as blocks
+        pattern = abs(G[0].data)
+        for G_t, _ in G[1:]:
+            pattern = pattern + abs(G_t.data)
+        n = pattern.shape[0]
+        # edge j -> i for G[i, j] != 0, plus a source node n linked to v0
+        source = np.zeros((1, n))
+        source[0, np.flatnonzero(v0)] = 1
+        graph = sp.bmat(
+            [[pattern.T, None], [sp.csr_matrix(source), sp.csr_matrix((1, 1))]]
+        ).tocsr()
+        reach = csgraph.breadth_first_order(graph, n, return_predecessors=False)
+        reach = np.sort(reach[reach < n])
+        _, labels = csgraph.connected_components(
+            pattern[reach][:, reach], directed=True, connection="weak"
+        )
+        return [reach[labels == k] for k in range(labels.max() + 1)]
+
+    def _block_eig(self, G, v, index):
+        # states of the block index of the state vector over tlist, from the
+        # eigendecomposition of a small time-independent block; None if the
+        # block has to be integrated, see _block_ode
+        if len(G) > 1 or len(index) > EIG_MAX_DIM:
+            return None
+        w, V = la.eig(G[0].data[index][:, index].toarray())
+        if np.linalg.cond(V) >= EIG_MAX_COND:
+            return None
+        c = la.solve(V, v)
+        tlist = self.tlist
+        return V @ (np.exp(np.outer(w, tlist - tlist[0])) * c[:, None])
+
+    def _block_solve(self, rho0, e_ops, options, workers):
+        # solve each block found by _blocks independently and record the
+        # reassembled states. Large blocks are diagonalised on a thread pool;
+        # large blocks that need the ODE solver run on a process pool, while
+        # the small ones are integrated here
+        coherent = rho0.isket and self.is_coherent()
+        G = self._generator(coherent)
+        rho = rho0 if coherent or not rho0.isket else qu.ket2dm(rho0)
+        record = _Recorder(
+            "blocks-ket" if coherent else "blocks",
+            self.tlist,
+            rho,
+            e_ops,
+            options.store_states,
+        )
+        v = record.vector(rho)
+        blocks = self._blocks(G, v)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = [
+                pool.submit(self._block_eig, G, v[b], b)
+                if len(b) >= BLOCK_PARALLEL_DIM
+                else None
+                for b in blocks
+            ]
+            states = [
+                future.result() if future else self._block_eig(G, v[b], b)
+                for future, b in zip(pending, blocks)
+            ]
+        ode = [k for k, state in enumerate(states) if state is None]
+        tasks = {}
+        for k in ode:
+            b = blocks[k]
+            H = [qu.Qobj(1j * G[0].data[b][:, b])]
+            H += [[qu.Qobj(1j * G_t.data[b][:, b]), func] for G_t, func in G[1:]]
+            tasks[k] = (H, v[b], self.tlist, self.args)
+        large = [k for k in ode if len(blocks[k]) >= BLOCK_PARALLEL_DIM]
+        if large and len(ode) > 1 and (workers or os.cpu_count()) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {k: pool.submit(_block_ode, *tasks[k]) for k in large}
+                for k in ode:
+                    if k not in futures:
+                        states[k] = _block_ode(*tasks[k])
+                for k, future in futures.items():
+                    states[k] = future.result()
+        else:
+            for k in ode:
+                states[k] = _block_ode(*tasks[k])
+        index = np.concatenate(blocks)
+        V = np.vstack(states)
+        record.extend(self.tlist, V, index)
+        record.result.blocks = [len(b) for b in blocks]
+        return record.finish(record.full(V[:, -1], index))
+
+    def _mc(self, H, rho0, e_ops, args, ntraj, workers):
+        # averages of ntraj wavefunction trajectories, run by qutip's mcsolve
+        # on a process pool of workers (all cpus by default). A mixed rho0 is
+        # sampled through its eigenstates, with the trajectories split by
+        # their weights. result.expect_error holds the standard error of each
+        # average as a convergence estimate; it falls as 1/sqrt(ntraj)
+        if any(not isinstance(op, qu.Qobj) for op in e_ops):
+            raise ValueError("Monte Carlo solves only support operator e_ops")
+        if rho0.isket:
+            mixture = [(1, rho0)]
+        else:
+            weights, kets = rho0.eigenstates()
+            mixture = [(w, ket) for w, ket in zip(weights, kets) if w > 1e-12]
+        options = qu.Options(average_expect=False, store_final_state=False)
+        if workers:
+            options.num_cpus = workers
+        tlist = self.tlist
+        mean = np.zeros((len(e_ops), len(tlist)), dtype=complex)
+        var = np.zeros((len(e_ops), len(tlist)))
+        n_total = 0
+        for w, ket in mixture:
+            n = max(2, int(round(w * ntraj)))
+            res = qu.mcsolve(
+                H,
+                ket,
+                tlist,
+                self.c_ops,
+                e_ops,
+                ntraj=n,
+                args=args,
+                options=options,
+                progress_bar=BaseProgressBar(),
+            )
+            # without c_ops mcsolve returns the single, exact trajectory
+            values = np.asarray(res.expect).reshape(-1, len(e_ops), len(tlist))
+            n = len(values)
+            mean += w * values.mean(axis=0)
+            if n > 1:
+                var += w**2 * values.var(axis=0, ddof=1) / n
+            n_total += n
+        result = qu.solver.Result()
+        result.solver = "mcsolve"
+        result.times = tlist
+        result.ntraj = n_total
+        result.num_expect = len(e_ops)
+        result.num_collapse = len(self.c_ops)
+        result.expect = [m.real if op.isherm else m for m, op in zip(mean, e_ops)]
+        result.expect_error = list(np.sqrt(var))
+        result.final_state = None
+        return result
+
+    def solve(
+        self,
+        verbose=False,
+        rho0=None,
+        cont_from_last_state=False,
+        store_states=True,
+        e_ops=None,
+        output=None,
+        coefficients=None,
+        method="ode",
+        ntraj=500,
+        workers=None,
+        flux=False,
+        cache=None,
+    ):
+        # e_ops (True for all of self.e_ops, a list of names or a dict of
+        # operators) are evaluated inside the integrator and returned as
+        # named arrays in result.expect; states are only kept if store_states.
+        # output overrides store_states and picks the states to keep: "final",
+        # every k-th step for an int k, or a list of times (added to tlist).
+        # The kept states and their times are result.states and
+        # result.sample_times; the integrator steps are unaffected.
+        # coefficients ("string", "array" or "step") replaces the Python pulse
+        # callbacks by compiled coefficients, see _compiled.
+        # method="piecewise" propagates the segments on which all pulses are
+        # constant with matrix exponentials, see _piecewise; it always
+        # evolves a density matrix. method="eig" evaluates all of tlist from
+        # the eigendecomposition of L for small time-independent systems and
+        # falls back to mesolve otherwise, see _eig. method="mc" averages
+        # ntraj quantum trajectories on workers processes and keeps no states,
+        # see _mc; result.expect_error holds the standard errors.
+        # method="blocks" solves the independent blocks of the state that
+        # follow from the sparsity of L and rho0 separately, see _blocks;
+        # result.blocks holds their sizes.
+        # With flux, result.flux holds the cumulative number of quantum jumps
+        # (emitted photons) through each collapse channel, by parameter key
+        # ("21gamma", "32kappa", ...), integrated from rates evaluated inside
+        # the integrator with the trapezoidal rule over tlist.
+        # Kets are evolved as kets when all collapse rates are zero (see
+        # is_coherent); result.solver names the path that was taken.
+        # cache (a ResultCache, or True for the default one) returns the
+        # stored result of an identical solve (result.cached) without
+        # solving, and stores new results; solves from a given rho0 or the
+        # last state, and with e_ops callbacks, are not cached.
+        t0 = time.time()
+        self.tlist = np.linspace(0, self.params["t_max"], self.params["n_step"])
+        if cache is True:
+            cache = ResultCache()
+        cache_key = None
+        if cache and rho0 is None and not cont_from_last_state:
+            options = {
+                "method": method,
+                "store_states": store_states,
+                "e_ops": e_ops,
+                "output": output,
+                "coefficients": coefficients,
+                "ntraj": ntraj if method == "mc" else None,
+                "flux": flux,
+            }
+            cache_key = self._cache_key(cache, options)
+            result = cache.get_result(cache_key) if cache_key else None
+            if result is not None:
+                self.result = result
+                self.last_state = result.final_state
+                if verbose:
+                    print("Loaded from cache")
+                return self.result, self.e_ops
+        if not rho0 and not cont_from_last_state:
+            self._rho()
+            rho0 = self.rho0
+        elif cont_from_last_state and self.last_state:
+            rho0 = self.last_state
+        sampler = None
+        if output is not None:
+            store_states = False
+            if isinstance(output, str):
+                if output != "final":
+                    raise ValueError("Unknown output policy: {}".format(output))
+            elif isinstance(output, (int, np.integer)):
+                steps = list(range(0, len(self.tlist), output))
+                sampler = _StateSampler(steps + [len(self.tlist) - 1])
+            else:
+                output = _snap(self.tlist, output)
+                self.tlist = np.union1d(self.tlist, output)
+                sampler = _StateSampler(np.searchsorted(self.tlist, output))
+        if e_ops is None and (not store_states or method == "mc"):
+            e_ops = True
+        e_ops = self._expect_ops(e_ops) if e_ops else {}
+        if flux:
+            for key, op in self._flux_ops().items():
+                e_ops[("flux", key)] = op
+        options = qu.Options(store_states=store_states, store_final_state=True)
+        # kets without dissipation are evolved with the Schroedinger equation
+        coherent = rho0.isket and self.is_coherent()
+        if method != "mc" and not coherent:
+            H = self.liouvillian()
+        else:
+            H = [self.H, *self.HL_t]
+        args = self.args
+        if coefficients and len(H) > 1:
+            if coefficients not in ("string", "array", "step"):
+                raise ValueError("Unknown coefficients: {}".format(coefficients))
+            H = H[:1] + self._compiled(H[1:], coefficients)
+            # the arg values are substituted, and keys like "12sigma" are
+            # not valid names in qutip's generated code
+            args = {"_step_func_coeff": coefficients == "step"}
+        e_list = list(e_ops.values()) + ([sampler] if sampler else [])
+        result = None
+        if method == "piecewise":
+            result = self._piecewise(rho0, e_list, options)
+        elif method == "eig":
+            result = self._eig(rho0, e_list, options)
+        elif method == "mc":
+            result = self._mc(H, rho0, e_list, args, ntraj, workers)
+        elif method == "blocks":
+            result = self._block_solve(rho0, e_list, options, workers)
+        elif method != "ode":
+            raise ValueError("Unknown solve method: {}".format(method))
+        if result is None:
+            solver = qu.sesolve if coherent else qu.mesolve
+            result = solver(
+                H, rho0, self.tlist, e_ops=e_list, options=options, args=args
+            )
+        self.result = result
+        self.result.expect = dict(zip(e_ops, self.result.expect))
+        if method == "mc":
+            self.result.expect_error = dict(zip(e_ops, self.result.expect_error))
+        if flux:
+            self.result.flux = {}
+            for key in self._flux_ops():
+                rate = np.real(self.result.expect.pop(("flux", key)))
+                rate *= self._values[key]
+                self.result.flux[key] = cumulative_trapezoid(
+                    rate, self.tlist, initial=0
+                )
+                if method == "mc":
+                    self.result.expect_error.pop(("flux", key))
+        self.last_state = self.result.final_state
+        if sampler:
+            self.result.states = sampler.states
+            self.result.sample_times = np.array(sampler.times)
+        elif output == "final":
+            self.result.states = [self.last_state]
+            self.result.sample_times = self.tlist[-1:]
+        if cache_key:
+            cache.put_result(cache_key, self.result)
+        t = time.time() - t0
+        if verbose:
+            print("Solved with {}".format(self.result.solver))
+            print("Time to solve system: {}".format(round(t, 5)))
+        return self.result, self.e_ops
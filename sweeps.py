@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel parameter sweeps over a compiled SystemTemplate.
+
+The grid is the outer product of one array of values per parameter key. Grid
+points are solved in chunks on a process pool; each worker receives the
+template once, when it starts, and only parameter values are sent per chunk.
+With continuation, the grid is walked along a snake path and every point in a
+chunk is started from the solution of the previous one.
+"""
+import itertools
+import multiprocessing as mp
+import os
+import warnings
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import qutip as qu
+from result_cache import ResultCache
+
+BLAS_THREAD_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+# template and fixed settings of the current worker process
+_worker = {}
+
+
+class SweepResult:
+    """
+    Expectation values on a parameter grid.
+
+    data has shape (*shape, len(observables)), where shape holds the length of
+    each grid axis in the order of axes; result[name] returns the grid of a
+    single observable.
+    """
+
+    def __init__(self, axes, observables, data):
+        self.axes = axes
+        self.observables = observables
+        self.data = data
+
+    @property
+    def shape(self):
+        return tuple(len(v) for v in self.axes.values())
+
+    def __getitem__(self, name):
+        return self.data[..., self.observables.index(name)]
+
+
+def _threadpoolctl():
+    try:
+        import threadpoolctl
+    except ImportError:
+        return None
+    return threadpoolctl
+
+
+def _limit_blas_threads(n):
+    # threadpool_limits pinning the BLAS threads of this process to n (also a
+    # context manager undoing it), or a null context without threadpoolctl
+    threadpoolctl = _threadpoolctl()
+    if threadpoolctl and n:
+        return threadpoolctl.threadpool_limits(n)
+    return nullcontext()
+
+
+def _start_worker(initializer, initargs, blas_threads):
+    # pinned for the life of the worker process
+    _limit_blas_threads(blas_threads)
+    initializer(*initargs)
+
+
+@contextmanager
+def worker_pool(initializer, initargs, workers=1, blas_threads=None):
+    """
+    Context giving a map(func, items) that runs on a pool of workers processes.
+
+    Each worker runs initializer(*initargs) once when it starts, so large
+    objects like a template are only sent once however many times map is
+    called; workers=1 runs everything in this process. blas_threads pins
+    the BLAS threads of each worker, which needs threadpoolctl unless the
+    workers are spawned rather than forked; with workers=1 this process is
+    only pinned while the context is open. By default workers are pinned to
+    one thread where that is possible, and this process is left alone.
+    """
+    forked = workers > 1 and mp.get_start_method() == "fork"
+    if blas_threads is None:
+        blas_threads = 1 if workers > 1 else 0
+    elif blas_threads and (workers == 1 or forked) and not _threadpoolctl():
+        warnings.warn(
+            "BLAS threads are not pinned without threadpoolctl", RuntimeWarning
+        )
+    if workers == 1:
+        with _limit_blas_threads(blas_threads):
+            initializer(*initargs)
+            yield lambda func, items: [func(item) for item in items]
+        return
+    env = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    if blas_threads:
+        # read by spawned workers (the default on Windows and macOS) when they
+        # import numpy; forked workers share the BLAS already loaded here, and
+        # are pinned by threadpoolctl in _start_worker
+        for var in BLAS_THREAD_VARS:
+            os.environ[var] = str(blas_threads)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_start_worker,
+            initargs=(initializer, initargs, blas_threads),
+        ) as pool:
+            yield lambda func, items: list(pool.map(func, items))
+    finally:
+        for var, val in env.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
+
+
+def parallel_map(func, items, initializer, initargs, workers=1, blas_threads=None):
+    # [func(item) for item in items] on a worker_pool
+    with worker_pool(initializer, initargs, workers, blas_threads) as map_:
+        return map_(func, items)
+
+
+def _init_worker(template, values, observables, options):
+    _worker["template"] = template
+    _worker["values"] = values
+    _worker["observables"] = observables
+    _worker["options"] = options
+
+
+def _solve_point(template, values, observables, options, seed=None):
+    # observables at one grid point and the state they were taken in. A seed
+    # state is the initial guess of iterative steady-state solvers, or the
+    # initial state of a time evolution shortened to a settle fraction
+    system = template.instantiate(values)
+    if options["mode"] == "steady":
+        kwargs = {}
+        if seed is not None and options["method"].startswith("iterative"):
+            kwargs["x0"] = qu.operator_to_vector(seed).full().ravel()
+        state = system.steady_state(options["method"], options["cache"], **kwargs)
+        return [qu.expect(op, state) for op in observables.values()], state
+    if seed is not None:
+        settle = options["settle"]
+        system.params["t_max"] = settle * system.params["t_max"]
+        system.params["n_step"] = max(2, int(round(settle * system.params["n_step"])))
+    result, _ = system.solve(
+        rho0=seed, store_states=False, e_ops=observables, cache=options["cache"]
+    )
+    return [result.expect[name][-1] for name in observables], result.final_state
+
+
+def _solve_chunk(chunk):
+    options = _worker["options"]
+    out = []
+    seed = None
+    for point in chunk:
+        values = dict(_worker["values"])
+        values.update(point)
+        row, state = _solve_point(
+            _worker["template"], values, _worker["observables"], options, seed
+        )
+        if options["continuation"]:
+            seed = state
+        out.append(row)
+    return out
+
+
+def _snake(shape):
+    # grid indices in an order in which consecutive points are neighbours
+    if not shape:
+        return [()]
+    rest = _snake(shape[1:])
+    order = []
+    for i in range(shape[0]):
+        order += [(i,) + idx for idx in (rest if i % 2 == 0 else rest[::-1])]
+    return order
+
+
+def _observables(template, observables):
+    if observables is None:
+        return dict(template.e_ops)
+    if isinstance(observables, dict):
+        return dict(observables)
+    return {name: template.e_ops[name] for name in observables}
+
+
+def sweep(
+    template,
+    grid,
+    observables=None,
+    values=None,
+    mode="final",
+    method="direct",
+    workers=None,
+    chunksize=None,
+    blas_threads=None,
+    continuation=False,
+    settle=0.25,
+    cache=None,
+):
+    """
+    Solve template at every point of grid, a dict of parameter key: values.
+
+    observables is a list of e_ops names or a dict of name: operator (all
+    e_ops by default). With mode="final" they are evaluated in the final
+    state of each time evolution, with mode="steady" in the steady state
+    found by steady_state(method). values holds fixed values for parameters
+    that are not swept. workers=1 solves in this process; blas_threads pins
+    the BLAS threads of each worker (see worker_pool).
+
+    With continuation=True the grid is walked along a snake path, and each
+    point in a chunk starts from the solution at its neighbour: as x0 for
+    iterative steady-state methods, or as the initial state of a time
+    evolution over settle times t_max (and n_step). The first point of each
+    chunk is solved from scratch, so the results depend on the chunks; by
+    default each chunk is one row along the last axis, whatever workers.
+
+    cache (a ResultCache, or True for the default one) is shared by the
+    workers; points that hit it are not solved again. Time evolutions started
+    from a neighbour's state are not cached.
+    """
+    if mode not in ("final", "steady"):
+        raise ValueError("Unknown sweep mode: {}".format(mode))
+    axes = {key: np.asarray(v) for key, v in grid.items()}
+    values = template.values(values)
+    unknown = set(axes) - set(values)
+    if unknown:
+        raise KeyError("Unknown parameters: {}".format(sorted(unknown)))
+    observables = _observables(template, observables)
+    options = {
+        "mode": mode,
+        "method": method,
+        "continuation": continuation,
+        "settle": settle,
+        "cache": ResultCache() if cache is True else cache,
+    }
+
+    keys = list(axes)
+    shape = tuple(len(v) for v in axes.values())
+    if continuation:
+        order = _snake(shape)
+    else:
+        order = list(itertools.product(*(range(n) for n in shape)))
+    points = [
+        {key: axes[key][i] for key, i in zip(keys, idx)} for idx in order
+    ]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(points)))
+    if chunksize is None and continuation:
+        # one chunk per row of the snake, so the result (which depends on
+        # where the chunks start) is the same for any number of workers
+        chunksize = shape[-1] if shape else 1
+    elif chunksize is None:
+        chunksize = max(1, int(np.ceil(len(points) / (4 * workers))))
+    chunks = [points[i : i + chunksize] for i in range(0, len(points), chunksize)]
+
+    initargs = (template, values, observables, options)
+    out = parallel_map(
+        _solve_chunk, chunks, _init_worker, initargs, workers, blas_threads
+    )
+    rows = [row for chunk in out for row in chunk]
+    _worker.clear()
+    if options["cache"] is not None and os.path.isdir(options["cache"].path):
+        # workers only account for their own writes, so bound the total here
+        options["cache"].evict()
+
+    data = np.zeros(shape + (len(observables),), dtype=complex)
+    for idx, row in zip(order, rows):
+        data[idx] = row
+    if np.all(np.isreal(data)):
+        data = data.real
+    return SweepResult(axes, list(observables), data)
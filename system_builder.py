@@ -10,10 +10,14 @@ import json
 import qutip as qu
 import numpy as np
 import qutipfuncs as quf
+import operators as ops
 from fractions import Fraction
 import time
 from qobjects import Level, Laser, Decay, Cavity
 from H_funcs import funcs, func_generator
+from solvers import SolverMixin
+import sweeps
+import optimize
 
 
 def build_system_from_dict(system_dict):
@@ -40,7 +44,14 @@ def build_system_from_dict(system_dict):
         return None
 
 
-class AtomSystem:
+def compile_system(system_dict):
+    atom_system = build_system_from_dict(system_dict)
+    if atom_system:
+        return atom_system.compile()
+    return None
+
+
+class AtomSystem(SolverMixin):
     def __init__(
         self, levels, lasers, params, decays=None, cavities=None, verbose=False
     ):
@@ -77,16 +88,80 @@ class AtomSystem:
         self._transitions()
         if self.cavity:
             self._cavity()
+        self._parameters()
+        self._cache = {}
+        self.H_terms = ops.ParametricOperator([self.dims, self.dims])
         self._Bfield()
         self._interactions()
         self._hamiltonian()
         self._decays()
+        self._update()
         self._rho()
         self._e_ops()
         t = time.time() - t0
         if self.verbose:
             print("Time to build system: {}".format(round(t, 5)))
 
+    def _parameters(self):
+        # scalar parameters the operators depend on, as key: (owner, attribute)
+        self.parameters = {}
+        for laser in self.lasers:
+            self.parameters[laser.name + "Omega"] = (laser, "Omega")
+            self.parameters[laser.name + "Delta"] = (laser, "Delta")
+            if laser.lw:
+                self.parameters[laser.name + "lw"] = (laser, "lw")
+            if laser.func:
+                for key in laser.args:
+                    self.parameters[key] = (laser.args, key)
+        for decay in self.decays:
+            self.parameters[decay.name + "gamma"] = (decay, "gamma")
+        if self.cavity:
+            name = self.cavity.name
+            self.parameters[name + "g"] = (self.cavity, "g")
+            self.parameters[name + "kappa"] = (self.cavity, "kappa")
+            self.parameters[name + "Delta_c"] = (self.cavity, "Delta")
+        self.parameters["B"] = (self.params, "B")
+
+    def get_parameter(self, key):
+        owner, attr = self.parameters[key]
+        if isinstance(owner, dict):
+            return owner[attr]
+        return getattr(owner, attr)
+
+    def set_parameter(self, key, val):
+        owner, attr = self.parameters[key]
+        if isinstance(owner, dict):
+            owner[attr] = val
+            self._update()
+        else:
+            setattr(owner, attr, val)
+
+    def parameter_values(self):
+        return {key: self.get_parameter(key) for key in self.parameters}
+
+    @property
+    def B(self):
+        return self.params["B"]
+
+    @B.setter
+    def B(self, val):
+        self.set_parameter("B", val)
+
+    @property
+    def args(self):
+        args = {}
+        for laser in self.lasers:
+            if laser.func:
+                args.update(laser.args)
+        return args
+
+    def _fingerprint(self):
+        return {"system": self.create_system_dict(), "values": self.parameter_values()}
+
+    def _update(self):
+        # re-evaluate H, HL_t and c_ops from the current parameter values
+        self._evaluate(self.parameter_values())
+
     def _atom(self):
         levels = self.levels
         self.astates = []
@@ -95,89 +170,85 @@ class AtomSystem:
             for level in levels:
                 level.J = 0
         self.Nat = sum([i.N for i in levels])
+        self.dims = [self.Nat]
+        if self.cavity:
+            self.dims += [self.cavity.N] * self.cavity.modes
+        self.Nc = int(np.prod(self.dims[1:]))
+        self.slices = {}
         n = 0
         for level in levels:
-            states = [qu.basis(self.Nat, i) for i in n + np.arange(level.N)]
-            self.astates.append(*states)
+            idx = n + np.arange(level.N)
+            states = [qu.basis(self.Nat, i) for i in idx]
+            self.astates.extend(states)
             level.states = states
-            self.projectors[level.name] = [i * i.dag() for i in states]
+            self.slices[level.name] = slice(n, n + level.N)
+            self.projectors[level.name] = [
+                self._op(ops.projector(self.Nat, i)) for i in idx
+            ]
             n += level.N
         self.Iat = qu.qeye(self.Nat)
 
+    def _op(self, matrix):
+        # wrap an atomic operator, extended over the cavity modes if present
+        return ops.to_qobj(ops.expand(matrix, self.Nc), self.dims)
+
+    def _diag_op(self, atom_values, cavity_values=None):
+        # wrap a diagonal operator given its atomic and cavity diagonals
+        values = np.kron(atom_values, np.ones(self.Nc))
+        if cavity_values is not None:
+            values += np.kron(np.ones(self.Nat), cavity_values)
+        return ops.to_qobj(ops.diagonal(values), self.dims)
+
     def _cavity(self):
         cavity = self.cavity
         cavity.system = self
         N = cavity.N
         self.Ic = qu.qeye(N)
-        for key in self.projectors.keys():
-            self.projectors[key] = [
-                qu.tensor(proj, *[qu.qeye(N) for _ in range(cavity.modes)])
-                for proj in self.projectors[key]
-            ]
-        for key in self.Aops.keys():
-            self.Aops[key] = [
-                qu.tensor(Aop, *[qu.qeye(N) for _ in range(cavity.modes)])
-                for Aop in self.Aops[key]
-            ]
         if cavity.modes == 1:
             self.a = qu.tensor(self.Iat, qu.destroy(N))
             self.ad = self.a.dag()
+            self.n_diag = np.arange(N)
         if cavity.modes == 2:
             self.a = qu.tensor(self.Iat, qu.destroy(N), qu.qeye(N))
             self.ad = self.a.dag()
             self.a2 = qu.tensor(self.Iat, qu.qeye(N), qu.destroy(N))
             self.ad2 = self.a2.dag()
+            self.n_diag = np.add.outer(np.arange(N), np.arange(N)).ravel()
 
     def _Bfield(self):
-        self.HB = 0
+        values = np.zeros(self.Nat)
         for level in self.levels:
             if level.J != 0:
                 scaling_factor = self.params["freq_scaling"]
                 w = quf.zeemanFS(level.J, level.S, level.L, 1e-4, scaling_factor)
-                for i, m in enumerate(level.M):
-                    self.HB += self.projectors[level.name][i] * m * w * self.params["B"]
+                values[self.slices[level.name]] = level.M * w
+        self.H_terms.add(self._diag_op(values), "B")
 
     def _transitions(self):
         levels = self.levels
-        self.Aops = {}
-        for p, level_g in enumerate(levels):
-            Jg = level_g.J
-            states_g = level_g.states
-            for q, level_e in enumerate(levels):
+        self.pairs = {}
+        for level_g in levels:
+            for level_e in levels:
                 if level_e.name != level_g.name:
-                    Je = level_e.J
-                    states_e = level_e.states
-                    # if not self.params["zeeman"]:
-                    name = level_g.name + level_e.name
-                    if level_g.J != 0:
-                        self.Aops[name] = [
-                            sum(
-                                [
-                                    states_g[i]
-                                    * states_e[j].dag()
-                                    * qu.clebsch(
-                                        Jg, 1, Je, level_g.M[i], k, level_e.M[j]
-                                    )
-                                    for i in range(level_g.N)
-                                    for j in range(level_e.N)
-                                ]
-                            )
-                            for k in [-1, 0, 1]
-                        ]
-                    else:
-                        self.Aops[name] = [
-                            sum(
-                                [
-                                    states_g[i] * states_e[j].dag()
-                                    for i in range(level_g.N)
-                                    for j in range(level_e.N)
-                                ]
-                            )
-                        ]
+                    self.pairs[level_g.name + level_e.name] = (level_g, level_e)
+        self.Aops = ops.LazyOperators(self.pairs, self._transition)
+        couplings = self.lasers + self.decays
+        if self.cavity:
+            couplings.append(self.cavity)
+        self.Aops.declare([coupling.name for coupling in couplings])
+
+    def _transition(self, name):
+        level_g, level_e = self.pairs[name]
+        row = self.slices[level_g.name].start
+        col = self.slices[level_e.name].start
+        if level_g.J != 0:
+            tables = [quf.cg_table(level_g.J, level_e.J, k) for k in [-1, 0, 1]]
+        else:
+            tables = [np.ones([level_g.N, level_e.N])]
+        return [self._op(ops.block(self.Nat, table, row, col)) for table in tables]
 
     def _interactions(self):
-        self.HL_0 = []
-        self.HL_t = []
+        self.H_t_terms = []
         for laser in self.lasers:
             name = laser.name
             if self.params["zeeman"]:
@@ -191,31 +262,30 @@ class AtomSystem:
             else:
                 HL = sum(self.Aops[name])
 
-            HL_0 = laser.Omega * (HL + HL.dag())
             if laser.func:
+                H_t = ops.ParametricOperator([self.dims, self.dims])
+                H_t.add(HL + HL.dag(), name + "Omega")
                 HL_func = func_generator(funcs[laser.func], laser.name)
-                self.HL_t.append([HL_0, HL_func])
+                self.H_t_terms.append((H_t, HL_func))
             else:
-                self.HL_0.append(HL_0)
+                self.H_terms.add(HL + HL.dag(), name + "Omega")
 
         cavity = self.cavity
         if cavity:
             name = cavity.name
             if cavity.modes == 1:
                 if self.params["zeeman"]:
-                    if cavity.modes == 1:
-                        pol_c = quf.conv_field_pol(cavity, self.Bdir)
-                        Hc = sum(
-                            [
-                                pol_c[i] * self.Aops[name][i]
-                                for i in range(len(self.Aops[name]))
-                            ]
-                        )
+                    pol_c = quf.conv_field_pol(cavity, self.Bdir)
+                    Hc = sum(
+                        [
+                            pol_c[i] * self.Aops[name][i]
+                            for i in range(len(self.Aops[name]))
+                        ]
+                    )
                 else:
                     Hc = sum(self.Aops[name])
-                self.Hc = (
-                    cavity.g * self.ad * Hc + np.conj(cavity.g) * self.a * Hc.dag()
-                )
+                self.H_terms.add(self.ad * Hc, name + "g")
+                self.H_terms.add(self.a * Hc.dag(), name + "g", conj=True)
             elif cavity.modes == 2:
                 pol_c1 = quf.conv_pol(cavity.k, [cavity.pol[0], 0, 0], self.Bdir)
                 Hc1 = sum(
@@ -224,9 +294,8 @@ class AtomSystem:
                         for i in range(len(self.Aops[name]))
                     ]
                 )
-                self.Hc1 = (
-                    cavity.g * self.ad * Hc1 + np.conj(cavity.g) * self.a * Hc1.dag()
-                )
+                self.H_terms.add(self.ad * Hc1, name + "g")
+                self.H_terms.add(self.a * Hc1.dag(), name + "g", conj=True)
                 pol_c2 = quf.conv_pol(cavity.k, [0, 0, cavity.pol[2]], self.Bdir)
                 Hc2 = sum(
                     [
@@ -234,13 +303,10 @@ class AtomSystem:
                         for i in range(len(self.Aops[name]))
                     ]
                 )
-                self.Hc2 = (
-                    cavity.g * self.ad2 * Hc2 + np.conj(cavity.g) * self.a2 * Hc2.dag()
-                )
-                self.Hc = self.Hc1 + self.Hc2
+                self.H_terms.add(self.ad2 * Hc2, name + "g")
+                self.H_terms.add(self.a2 * Hc2.dag(), name + "g", conj=True)
 
     def _hamiltonian(self):
-        H0 = []
         for level in self.levels:
             level.laser_count = 0
             name = level.name
@@ -253,40 +319,31 @@ class AtomSystem:
                 name = laser.L2
             else:
                 name = laser.L1
-            proj = sum(self.projectors[name])
-            H0.append(laser.Delta * proj)
+            proj = np.zeros(self.Nat)
+            proj[self.slices[name]] = 1
+            self.H_terms.add(self._diag_op(proj), laser.name + "Delta")
         if self.cavity:
             name = self.cavity.name
-            dL = 0
+            n_op = self._diag_op(np.zeros(self.Nat), self.n_diag)
+            self.H_terms.add(n_op, name + "Delta_c")
             for laser in self.lasers:
                 if laser.name == name:
-                    dL = laser.Delta
-            n_op = self.ad * self.a
-            if self.cavity.modes == 2:
-                n_op += self.ad2 * self.a2
-            H0.append((self.cavity.Delta - dL) * n_op)
-        self.H0 = sum(H0)
-
-        self.H = self.H0 + sum(self.HL_0) + self.HB
-        if self.cavity:
-            self.H += self.Hc
+                    self.H_terms.add(n_op, laser.name + "Delta", factor=-1)
 
     def _decays(self):
-        self.c_ops = []
+        # collapse operators as (operator, key, factor), c = sqrt(factor * value) * op
+        self.c_terms = []
         for decay in self.decays:
             name = decay.name
             for Aop in self.Aops[name]:
-                c_op = np.sqrt(decay.gamma) * Aop.dag()
-                self.c_ops.append(c_op)
+                self.c_terms.append((Aop.dag(), name + "gamma", 1))
         if self.cavity:
             name = self.cavity.name
-            c_op = np.sqrt(2 * self.cavity.kappa) * self.a
-            self.c_ops.append(c_op)
+            self.c_terms.append((self.a, name + "kappa", 2))
         for laser in self.lasers:
             if laser.lw:
                 c = sum(self.projectors[laser.L1]) - sum(self.projectors[laser.L2])
-                c_op = np.sqrt(laser.lw) * c
-                self.c_ops.append(c_op)
+                self.c_terms.append((c, laser.name + "lw", 1))
 
     def _e_ops(self):
         levels = self.levels
@@ -339,36 +396,70 @@ class AtomSystem:
 
             self.rho0 = self.rho0.unit()
 
-    def solve(self, verbose=False, rho0=None, cont_from_last_state=False):
-        t0 = time.time()
-        self.tlist = np.linspace(0, self.params["t_max"], self.params["n_step"])
-        if not rho0 and not cont_from_last_state:
-            self._rho()
-            rho0 = self.rho0
-        elif cont_from_last_state and self.last_state:
-            rho0 = self.last_state
-        self._e_ops
-        options = qu.Options(store_states=True)
-        self.args = {}
-        for laser in self.lasers:
-            if laser.func:
-                self.args.update(laser.args)
-        self.result = qu.mesolve(
-            [self.H, *self.HL_t],
-            rho0,
-            self.tlist,
-            c_ops=self.c_ops,
-            options=options,
-            args=self.args,
-        )
-        self.last_state = self.result.states[-1]
-        t = time.time() - t0
-        if verbose:
-            print("Time to solve system: {}".format(round(t, 5)))
-        return self.result, self.e_ops
+    def compile(self):
+        return SystemTemplate(self)
+
+    def _top_fock(self):
+        # projector onto the states with any cavity mode in its top Fock state
+        top = np.arange(self.cavity.N) == self.cavity.N - 1
+        if self.cavity.modes == 2:
+            top = np.logical_or.outer(top, top).ravel()
+        return self._diag_op(np.zeros(self.Nat), top.astype(float))
+
+    def solve_adaptive(self, tol=1e-4, N_start=2, N_max=30, e_ops=None, **kwargs):
+        # solve with the smallest cavity truncation for which the population
+        # of the top Fock state stays below tol. N grows from N_start, and a
+        # solve is abandoned as soon as the population exceeds tol. The
+        # population is returned as result.expect["top Fock"] and the
+        # converged truncation as result.N (and cavity.N). e_ops are given as
+        # names, since operators change with N; kwargs go to solve
+        cavity = self.cavity
+        if cavity is None:
+            raise ValueError("Adaptive truncation requires a cavity")
+        if kwargs.get("method") == "mc":
+            # the top Fock population is monitored by an e_ops callback
+            raise ValueError("Adaptive truncation does not support method='mc'")
+        N_orig = cavity.N
+        N = max(N_start, cavity.n + 2, cavity.n2 + 2)
+        if e_ops is None and not kwargs.get("store_states", True):
+            e_ops = True
+        try:
+            while N <= N_max:
+                if cavity.N != N:
+                    cavity.N = N
+                expect = self._expect_ops(e_ops) if e_ops else {}
+                expect["top Fock"] = _FockMonitor(self._top_fock(), tol)
+                try:
+                    result, e_ops_all = self.solve(e_ops=expect, **kwargs)
+                except _TruncationExceeded:
+                    N += 1
+                    continue
+                result.expect["top Fock"] = np.real(result.expect["top Fock"])
+                result.N = N
+                return result, e_ops_all
+            raise ValueError(
+                "Cavity truncation not converged for N <= {}".format(N_max)
+            )
+        except Exception:
+            # leave the system as it was if no truncation converged
+            if cavity.N != N_orig:
+                cavity.N = N_orig
+            raise
+
+    def sweep(self, grid, observables=None, **kwargs):
+        # solve on a grid of parameter values, see sweeps.sweep
+        return sweeps.sweep(self.compile(), grid, observables, **kwargs)
+
+    def gradient(self, objective, keys=None, **kwargs):
+        # gradient of an integrated objective, see optimize.gradient
+        return optimize.gradient(self.compile(), objective, keys, **kwargs)
+
+    def optimize(self, objective, bounds, **kwargs):
+        # batched Bayesian optimisation of an objective, see optimize.optimize
+        return optimize.optimize(self.compile(), objective, bounds, **kwargs)
 
     def create_system_dict(self):
-        system_dict = {}
+        system_dict = {"levels": {}}
         for level in self.levels:
             d = level.create_dict()
             system_dict["levels"][level.name] = d
@@ -383,7 +474,7 @@ class AtomSystem:
         system_dict["cavities"] = []
         if self.cavity:
             d = self.cavity.create_dict()
-            system_dict["cavitiies"].append(d)
+            system_dict["cavities"].append(d)
         system_dict["params"] = self.params
         return system_dict
 
@@ -397,3 +488,97 @@ class AtomSystem:
         all_systems[name] = copy.deepcopy(system_dict)
         with open("systems.json", "w") as systems:
             json.dump(all_systems, systems, indent=4)
+
+
+class _TruncationExceeded(Exception):
+    pass
+
+
+class _FockMonitor:
+    # e_ops callback returning the population of op, the top Fock states, and
+    # stopping the solve once it exceeds tol
+    def __init__(self, op, tol):
+        self.op = op
+        self.tol = tol
+
+    def __call__(self, t, state):
+        p = qu.expect(self.op, state)
+        if p > self.tol:
+            raise _TruncationExceeded()
+        return p
+
+
+class SystemTemplate:
+    """
+    Immutable operator components of an AtomSystem's level/coupling topology.
+
+    Parameter values enter only as scalar coefficients, so instantiate() can
+    produce a ready-to-solve system for a new flat parameter vector (ordered
+    as self.keys) without redoing any operator algebra. Templates are
+    picklable, so they can be shipped once to worker processes.
+    """
+
+    def __init__(self, system):
+        d = self.__dict__
+        d["keys"] = tuple(system.parameters)
+        d["arg_keys"] = tuple(system.args)
+        d["defaults"] = tuple(system.get_parameter(key) for key in self.keys)
+        d["H_terms"] = system.H_terms
+        d["H_t_terms"] = tuple(system.H_t_terms)
+        d["c_terms"] = tuple(system.c_terms)
+        d["e_ops"] = dict(system.e_ops)
+        d["rho0"] = system.rho0
+        d["params"] = copy.deepcopy(system.params)
+        d["system_dict"] = copy.deepcopy(system.create_system_dict())
+        d["_cache"] = system._cache
+
+    def __setattr__(self, name, val):
+        raise AttributeError("SystemTemplate is immutable")
+
+    def values(self, values=None):
+        # parameter values as a dict, from a flat vector or a dict of overrides
+        if values is None:
+            values = {}
+        if not isinstance(values, dict):
+            if len(values) != len(self.keys):
+                raise ValueError(
+                    "Expected {} parameter values, got {}".format(
+                        len(self.keys), len(values)
+                    )
+                )
+            return dict(zip(self.keys, values))
+        unknown = set(values) - set(self.keys)
+        if unknown:
+            raise KeyError("Unknown parameters: {}".format(sorted(unknown)))
+        full = dict(zip(self.keys, self.defaults))
+        full.update(values)
+        return full
+
+    def instantiate(self, values=None):
+        return CompiledSystem(self, self.values(values))
+
+
+class CompiledSystem(SolverMixin):
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+        self.H_terms = template.H_terms
+        self.H_t_terms = template.H_t_terms
+        self.c_terms = template.c_terms
+        self._cache = template._cache
+        self.e_ops = template.e_ops
+        self.params = dict(template.params)
+        self.params["B"] = values["B"]
+        self.args = {key: values[key] for key in template.arg_keys}
+        self.result = None
+        self.last_state = None
+        self._rho()
+        self._evaluate(values)
+
+    def _fingerprint(self):
+        # the current params, which may have been changed since compiling
+        system = dict(self.template.system_dict, params=self.params)
+        return {"system": system, "values": self.values}
+
+    def _rho(self):
+        self.rho0 = self.template.rho0